@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of model_stats hot paths on synthetic station networks
+
+Times model_eval_setup(), all_aqs_all_vars(), global_stat() and the
+wind direction metrics from 5 stations x 1 week to 500 stations x 5
+years. Results are saved to json, and compared with a previous run
+when --baseline is given (exit code 1 if something got slower).
+
+    python benchmarks/bench_model_stats.py --sizes small medium --json now.json
+    python benchmarks/bench_model_stats.py --sizes small medium --baseline now.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wrf_sp_eval.data_preparation as dp
+import wrf_sp_eval.model_stats as ms
+from synthetic_stations import synthetic_network
+
+
+# (stations, days)
+SIZES = {
+    'small': (5, 7),
+    'medium': (50, 365),
+    'large': (200, 2 * 365),
+    'xlarge': (500, 5 * 365)
+}
+
+
+def timed(fun, *args, repeat=1, **kwargs):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fun(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return (best, result)
+
+
+def wind_dir_metrics(model_dic, obs_dic):
+    return {k: (ms.wind_dir_mb(model_dic[k], obs_dic[k]),
+                ms.wind_dir_mage(model_dic[k], obs_dic[k]))
+            for k in model_dic}
+
+
+def bench_model_stats(size, repeat=1, seed=0):
+    '''
+    Run model_stats benchmarks for one network size
+
+    Parameters
+    ----------
+    size : str
+        Key of SIZES.
+    repeat : int, optional
+        Repetitions, the best time is kept. The default is 1.
+    seed : int, optional
+        Random seed. The default is 0.
+
+    Returns
+    -------
+    results : list of dict
+        One row per benchmark.
+
+    '''
+    n_stations, n_days = SIZES[size]
+    results = []
+    for kind in ['met', 'pol']:
+        model_dic, obs_dic, date_start = synthetic_network(
+            n_stations, n_days, kind=kind, seed=seed)
+        rows = sum(len(df.index) for df in model_dic.values())
+
+        def add(bench, seconds):
+            results.append({'bench': bench, 'kind': kind, 'size': size,
+                            'stations': n_stations, 'days': n_days,
+                            'rows': rows, 'seconds': seconds})
+
+        seconds, (model_dic, obs_dic) = timed(
+            lambda: dp.model_eval_setup(dict(model_dic), dict(obs_dic),
+                                        date_start), repeat=repeat)
+        add('model_eval_setup', seconds)
+        add('all_aqs_all_vars', timed(ms.all_aqs_all_vars, model_dic,
+                                      obs_dic, repeat=repeat)[0])
+        add('global_stat', timed(ms.global_stat, model_dic, obs_dic,
+                                 repeat=repeat)[0])
+        if kind == 'met':
+            add('wind_dir_metrics', timed(wind_dir_metrics, model_dic,
+                                          obs_dic, repeat=repeat)[0])
+    return results
+
+
+def compare_baseline(results, baseline, tolerance=1.25):
+    '''
+    Benchmarks slower than tolerance times the baseline
+    '''
+    key = lambda row: (row['bench'], row['kind'], row['size'])
+    base = {key(row): row['seconds'] for row in baseline}
+    slower = []
+    for row in results:
+        if key(row) in base and row['seconds'] > tolerance * base[key(row)]:
+            slower.append((key(row), base[key(row)], row['seconds']))
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', nargs='+', default=['small'],
+                        choices=list(SIZES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', default=None,
+                        help='save results in this json file')
+    parser.add_argument('--baseline', default=None,
+                        help='json file from a previous run')
+    parser.add_argument('--tolerance', type=float, default=1.25)
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        results += bench_model_stats(size, repeat=args.repeat)
+    for row in results:
+        print("{size:7s} {kind:4s} {bench:18s} {rows:10d} rows "
+              "{seconds:9.3f} s".format(**row))
+
+    if args.json is not None:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as base:
+            slower = compare_baseline(results, json.load(base),
+                                      args.tolerance)
+        for key, before, now in slower:
+            print("SLOWER {}: {:.3f} s -> {:.3f} s".format(key, before, now))
+        sys.exit(1 if slower else 0)
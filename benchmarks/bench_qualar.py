@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of QUALAR download path against the offline stand-in server
+
+Measures requests per second of cetesb_data_download(), all_met() and
+all_photo(), and the parse time of a QUALAR export page.
+
+    python benchmarks/bench_qualar.py --days 365 --stations 5 --latency 0.05
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import datetime as dt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wrf_sp_eval.qualar_py as qr
+from qualar_server import QualarServer
+
+
+def timed(fun, *args, **kwargs):
+    start = time.perf_counter()
+    result = fun(*args, **kwargs)
+    return (time.perf_counter() - start, result)
+
+
+def bench_qualar(days=31, stations=5, latency=0.0, n_workers=1,
+                 repeat=3, record_dir=None):
+    '''
+    Run the download benchmarks
+
+    Parameters
+    ----------
+    days : int, optional
+        Days downloaded in each request. The default is 31.
+    stations : int, optional
+        Number of stations. The default is 5.
+    latency : float, optional
+        Server latency per request in seconds. The default is 0.
+    n_workers : int, optional
+        Concurrent downloads for all_met() and all_photo(). The
+        default is 1.
+    repeat : int, optional
+        Repetitions of the parse benchmark. The default is 3.
+    record_dir : str, optional
+        Recorded pages served by the stand-in. The default is None.
+
+    Returns
+    -------
+    results : list of dict
+        One row per benchmark.
+
+    '''
+    server = QualarServer(latency=latency, record_dir=record_dir).start()
+    qr.QUALAR_URL = server.url
+    # Brazil has no daylight saving time since 2019
+    start_date = dt.date(2019, 6, 1)
+    end_date = start_date + dt.timedelta(days=days - 1)
+    start_date = start_date.strftime('%d/%m/%Y')
+    end_date = end_date.strftime('%d/%m/%Y')
+    codes = list(range(1, stations + 1))
+    results = []
+
+    def add(bench, seconds, n_requests):
+        results.append({'bench': bench, 'days': days, 'stations': stations,
+                        'latency': latency, 'n_workers': n_workers,
+                        'seconds': seconds, 'requests': n_requests,
+                        'requests_per_s': n_requests / seconds})
+
+    # cetesb_data_download, one login per series
+    seconds, _ = timed(lambda: [qr.cetesb_data_download(
+        'user', 'pass', start_date, end_date, 63, code) for code in codes])
+    add('cetesb_data_download', seconds, 2 * len(codes))
+
+    # all_met and all_photo, one client for all stations
+    for bench, fun in [('all_met', qr.all_met), ('all_photo', qr.all_photo)]:
+        with qr.QualarClient('user', 'pass',
+                             pool_size=max(n_workers, 1)) as client:
+            seconds, _ = timed(lambda: [fun('user', 'pass', start_date,
+                                            end_date, code,
+                                            n_workers=n_workers,
+                                            client=client)
+                                        for code in codes])
+            add(bench, seconds, client.requests)
+
+    # Parse only, no network
+    with qr.QualarClient('user', 'pass') as client:
+        content = client.search(start_date, end_date, 63, codes[0])
+    seconds = min(timed(qr.qualar_data_frame, content, start_date,
+                        end_date)[0] for _ in range(repeat))
+    add('qualar_data_frame', seconds, 1)
+
+    server.shutdown()
+    server.server_close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--days', type=int, default=31)
+    parser.add_argument('--stations', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--record-dir', default=None)
+    parser.add_argument('--json', default=None,
+                        help='save results in this json file')
+    args = parser.parse_args()
+
+    results = bench_qualar(args.days, args.stations, args.latency,
+                           args.workers, args.repeat, args.record_dir)
+    for row in results:
+        print("{bench:22s} {seconds:9.3f} s {requests:6d} req "
+              "{requests_per_s:9.1f} req/s".format(**row))
+    if args.json is not None:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
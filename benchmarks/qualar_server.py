@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline stand-in for CETESB QUALAR
+
+Serves the /qualar/autenticador and exportaDados.do?method=pesquisar
+endpoints used by wrf_sp_eval.qualar_py, returning synthetic tbl pages
+(or recorded pages) with configurable latency, so the download path can
+be benchmarked and tested without the live site.
+
+Run it alone with:
+    python benchmarks/qualar_server.py --port 8080 --latency 0.1
+and set wrf_sp_eval.qualar_py.QUALAR_URL = "http://127.0.0.1:8080/qualar"
+"""
+
+import os
+import time
+import uuid
+import zlib
+import argparse
+import threading
+import pandas as pd
+from urllib.parse import parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+def synthetic_value(parameter, station, day, hour):
+    '''
+    Deterministic value for a parameter, station and hour, so the same
+    hour has the same value whatever period is requested.
+    Returns None for about 5 % of the hours (missing data).
+    '''
+    key = "{}_{}_{}_{}".format(parameter, station, day, hour).encode()
+    seed = zlib.crc32(key)
+    if seed % 20 == 0:
+        return None
+    return (seed % 10000) / 100.0
+
+
+def synthetic_page(start_date, end_date, parameter, station):
+    '''
+    QUALAR like export page with one row per hour between start_date
+    and end_date (%d/%m/%Y). Hours go from 01:00 to 24:00.
+    '''
+    day1 = pd.to_datetime(start_date, format='%d/%m/%Y')
+    day2 = pd.to_datetime(end_date, format='%d/%m/%Y')
+    rows = []
+    for day in pd.date_range(day1, day2, freq='D').strftime('%d/%m/%Y'):
+        for hour in range(1, 25):
+            val = synthetic_value(parameter, station, day, hour)
+            if val is None:
+                continue
+            rows.append(
+                "<tr><td>A</td><td>{st}</td><td>P</td><td>{day}</td>"
+                "<td>{hour:02d}:00</td><td>M</td><td>Station {st}</td>"
+                "<td>Parameter {par}</td><td>unit</td><td>{val}</td></tr>"
+                .format(st=station, day=day, hour=hour, par=parameter,
+                        val=str(val).replace('.', ',')))
+    page = ("<html><body><table id=\"tbl\">"
+            "<tr><th>Dados</th></tr><tr><th>Rede</th></tr>"
+            + "".join(rows) +
+            "</table></body></html>")
+    return page.encode('utf-8')
+
+
+LOGIN_PAGE = b"<html><body><form>login</form></body></html>"
+
+
+class QualarHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def send_page(self, content, cookie=None):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        if cookie is not None:
+            self.send_header('Set-Cookie',
+                             'JSESSIONID=' + cookie + '; Path=/')
+        self.end_headers()
+        self.wfile.write(content)
+
+    def session_id(self):
+        for cookie in (self.headers.get('Cookie') or '').split(';'):
+            key, _, value = cookie.strip().partition('=')
+            if key == 'JSESSIONID':
+                return value
+        return None
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        form = {k: v[0] for k, v in
+                parse_qs(self.rfile.read(length).decode()).items()}
+        if server.latency > 0:
+            time.sleep(server.latency)
+
+        if self.path.endswith('/autenticador'):
+            token = uuid.uuid4().hex
+            with server.lock:
+                server.sessions[token] = time.time()
+                server.counts['login'] += 1
+            self.send_page(b"<html>ok</html>", cookie=token)
+        elif 'exportaDados.do' in self.path:
+            token = self.session_id()
+            with server.lock:
+                server.counts['search'] += 1
+                logged = token in server.sessions
+                if logged and server.session_ttl is not None:
+                    logged = (time.time() - server.sessions[token] <
+                              server.session_ttl)
+            if not logged:
+                self.send_page(LOGIN_PAGE)
+                return
+            self.send_page(server.page(form['dataInicialStr'],
+                                       form['dataFinalStr'],
+                                       form['parametroVO.nparmt'],
+                                       form['estacaoVO.nestcaMonto']))
+        else:
+            self.send_error(404)
+
+
+class QualarServer(ThreadingHTTPServer):
+    '''
+    QUALAR stand-in server
+
+    Parameters
+    ----------
+    port : int, optional
+        Port, 0 picks a free one. The default is 0.
+    latency : float, optional
+        Seconds added to each response. The default is 0.
+    session_ttl : float, optional
+        Seconds before a login expires. The default is None (never).
+    record_dir : str, optional
+        Folder with recorded pages named {parameter}_{station}.html,
+        served instead of synthetic pages when available. The
+        default is None.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, session_ttl=None,
+                 record_dir=None):
+        super().__init__(('127.0.0.1', port), QualarHandler)
+        self.latency = latency
+        self.session_ttl = session_ttl
+        self.record_dir = record_dir
+        self.sessions = {}
+        self.counts = {'login': 0, 'search': 0}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/qualar".format(self.server_address[1])
+
+    def page(self, start_date, end_date, parameter, station):
+        if self.record_dir is not None:
+            file_name = os.path.join(self.record_dir,
+                                     "{}_{}.html".format(parameter, station))
+            if os.path.exists(file_name):
+                with open(file_name, 'rb') as recorded:
+                    return recorded.read()
+        return synthetic_page(start_date, end_date, parameter, station)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+def record_qualar_pages(client, start_date, end_date, jobs, record_dir):
+    '''
+    Save QUALAR export pages to be replayed by QualarServer
+
+    Parameters
+    ----------
+    client : wrf_sp_eval.qualar_py.QualarClient
+        Logged client to the live QUALAR.
+    start_date : str
+        Start date in %d/%m/%Y.
+    end_date : str
+        End date in %d/%m/%Y.
+    jobs : list of tuple
+        (parameter, station) codes to record.
+    record_dir : str
+        Output folder.
+
+    Returns
+    -------
+    None.
+
+    '''
+    os.makedirs(record_dir, exist_ok=True)
+    for parameter, station in jobs:
+        content = client.search(start_date, end_date, parameter, station)
+        file_name = os.path.join(record_dir,
+                                 "{}_{}.html".format(parameter, station))
+        with open(file_name, 'wb') as recorded:
+            recorded.write(content)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--session-ttl', type=float, default=None)
+    parser.add_argument('--record-dir', default=None)
+    args = parser.parse_args()
+    server = QualarServer(args.port, args.latency, args.session_ttl,
+                          args.record_dir)
+    print("QUALAR stand-in at " + server.url)
+    server.serve_forever()
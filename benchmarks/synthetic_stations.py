@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic station networks for benchmarks
+
+Builds model and observation dictionaries with the same shape as
+cetesb_from_wrf(..., to_local=True) and download_load_cetesb_met()/_pol()
+(all_met()/all_photo()) output.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+MET_VARS = ['t2', 'rh2', 'ws', 'wd']
+POL_VARS = ['o3', 'no', 'no2', 'co']
+
+
+def synthetic_series(rng, var, n_hours):
+    '''
+    Hourly series with a daily cycle for one variable
+    '''
+    hour = np.arange(n_hours) % 24
+    cycle = np.sin((hour - 9) / 24 * 2 * np.pi)
+    if var == 't2':
+        return 293 + 5 * cycle + rng.normal(0, 1.5, n_hours)
+    if var == 'rh2':
+        return np.clip(70 - 20 * cycle + rng.normal(0, 5, n_hours), 5, 100)
+    if var == 'ws':
+        return np.abs(2 + cycle + rng.normal(0, 1, n_hours))
+    if var == 'wd':
+        return (120 + 60 * cycle + rng.normal(0, 40, n_hours)) % 360
+    if var == 'co':
+        return np.abs(0.6 - 0.3 * cycle + rng.normal(0, 0.2, n_hours))
+    if var == 'o3':
+        return np.abs(60 + 50 * cycle + rng.normal(0, 15, n_hours))
+    return np.abs(30 - 20 * cycle + rng.normal(0, 10, n_hours))
+
+
+def add_gaps(rng, values, nan_frac=0.05, outages=2, max_outage=72):
+    '''
+    Remove random hours and a few multi-hour outages (e.g. station
+    maintenance)
+    '''
+    values = values.copy()
+    values[rng.random(values.size) < nan_frac] = np.nan
+    for _ in range(outages):
+        start = rng.integers(0, values.size)
+        values[start:start + rng.integers(1, max_outage)] = np.nan
+    return values
+
+
+def synthetic_network(n_stations, n_days, kind='pol', spin_up=3,
+                      start='2019-06-01', nan_frac=0.05, seed=0):
+    '''
+    Synthetic model and observation dictionaries
+
+    Parameters
+    ----------
+    n_stations : int
+        Number of stations.
+    n_days : int
+        Simulated days, spin-up included.
+    kind : str, optional
+        'met' (t2, rh2, ws, wd) or 'pol' (o3, no, no2, co). The
+        default is 'pol'.
+    spin_up : int, optional
+        Days of model spin-up. The default is 3.
+    start : str, optional
+        Simulation start (UTC). Start from 2019, when Brazil stopped
+        using daylight saving time. The default is '2019-06-01'.
+    nan_frac : float, optional
+        Fraction of missing observations. The default is 0.05.
+    seed : int, optional
+        Random seed. The default is 0.
+
+    Returns
+    -------
+    model_dic : dict
+        Model DataFrames per station (cetesb_from_wrf() shape).
+    obs_dic : dict
+        Observation DataFrames per station (all_met()/all_photo() shape).
+    date_start : str
+        First date after spin-up, for model_eval_setup().
+
+    '''
+    rng = np.random.default_rng(seed)
+    var_names = MET_VARS if kind == 'met' else POL_VARS
+
+    model_date = (pd.date_range(start, periods=n_days * 24, freq='h',
+                                tz='UTC', name='date')
+                  .tz_convert('America/Sao_Paulo'))
+    # QUALAR download covers whole local days
+    obs_date = pd.date_range(model_date[0].normalize().tz_localize(None),
+                             model_date[-1].normalize().tz_localize(None) +
+                             pd.Timedelta(days=1), freq='h')
+    obs_date = obs_date.tz_localize('America/Sao_Paulo')
+    in_model = obs_date.isin(model_date)
+
+    model_dic = {}
+    obs_dic = {}
+    for i in range(n_stations):
+        name = 'Station {:03d}'.format(i)
+        obs = {}
+        model = {}
+        for var in var_names:
+            truth = synthetic_series(rng, var, obs_date.size)
+            obs[var] = add_gaps(rng, truth, nan_frac=nan_frac)
+            bias = rng.normal(0, 0.1) * np.nanstd(truth)
+            mod = truth[in_model] + bias + rng.normal(0, 0.5, in_model.sum()) \
+                * np.nanstd(truth)
+            if var == 'wd':
+                mod = mod % 360
+            model[var] = mod.astype('float32')
+        model_df = pd.DataFrame(model, index=model_date)
+        model_df.insert(0, 'name', name)
+        model_df.insert(0, 'code', i)
+        model_dic[name] = model_df
+        obs_dic[name] = pd.DataFrame(obs, index=obs_date)
+
+    date_start = (model_date[0] + pd.Timedelta(days=spin_up)).strftime(
+        '%Y-%m-%d')
+    return (model_dic, obs_dic, date_start)
@@ -11,25 +11,27 @@ from netCDF4 import Dataset
 import wrf_sp_eval.data_preparation as dp
 import wrf_sp_eval.qualar_py as qr
 import wrf_sp_eval.model_stats as ms
+import wrf_sp_eval.profiling as prof
 
 
 # Reading wrfout
 wrfout = Dataset("wrfout_d02_2018-06-21_00:00:00")
 
-# Extracting met variables
-t2 = wrf.getvar(wrfout, "T2", timeidx=wrf.ALL_TIMES, method="cat")
-rh2 = wrf.getvar(wrfout, "rh2", timeidx=wrf.ALL_TIMES, method="cat")
-psfc = wrf.getvar(wrfout, "PSFC", timeidx=wrf.ALL_TIMES, method="cat")
-wind = wrf.getvar(wrfout, "uvmet10_wspd_wdir", timeidx=wrf.ALL_TIMES,
-                  method="cat")
-ws = wind.sel(wspd_wdir="wspd")
-wd = wind.sel(wspd_wdir="wdir")
+# Extracting met and pollutants variables (profiled as one stage)
+with prof.stage("wrf.getvar"):
+    t2 = wrf.getvar(wrfout, "T2", timeidx=wrf.ALL_TIMES, method="cat")
+    rh2 = wrf.getvar(wrfout, "rh2", timeidx=wrf.ALL_TIMES, method="cat")
+    psfc = wrf.getvar(wrfout, "PSFC", timeidx=wrf.ALL_TIMES, method="cat")
+    wind = wrf.getvar(wrfout, "uvmet10_wspd_wdir", timeidx=wrf.ALL_TIMES,
+                      method="cat")
+    ws = wind.sel(wspd_wdir="wspd")
+    wd = wind.sel(wspd_wdir="wdir")
 
-# Extracting pollutants variables
-o3 = wrf.getvar(wrfout, "o3", timeidx=wrf.ALL_TIMES, method="cat")
-co = wrf.getvar(wrfout, "co", timeidx=wrf.ALL_TIMES, method="cat")
-no = wrf.getvar(wrfout, "no", timeidx=wrf.ALL_TIMES, method="cat")
-no2 = wrf.getvar(wrfout, "no2", timeidx=wrf.ALL_TIMES, method="cat")
+    # Pollutants
+    o3 = wrf.getvar(wrfout, "o3", timeidx=wrf.ALL_TIMES, method="cat")
+    co = wrf.getvar(wrfout, "co", timeidx=wrf.ALL_TIMES, method="cat")
+    no = wrf.getvar(wrfout, "no", timeidx=wrf.ALL_TIMES, method="cat")
+    no2 = wrf.getvar(wrfout, "no2", timeidx=wrf.ALL_TIMES, method="cat")
 
 
 # Retrieving pollutants from surface
@@ -38,10 +40,10 @@ co_sfc = co.isel(bottom_top=0)
 no_sfc = no.isel(bottom_top=0)
 no2_sfc = no2.isel(bottom_top=0)
 
-# Transform surface polutant from ppm to ug/m3
-o3_u = dp.ppm_to_ugm3(o3_sfc, t2, psfc, 48)
-no_u = dp.ppm_to_ugm3(no_sfc, t2, psfc, 30)
-no2_u = dp.ppm_to_ugm3(no2_sfc, t2, psfc, 46)
+# Transform surface polutant from ppm to ug/m3 (CO stays in ppm),
+# molecular masses are in dp.SPECIES
+pols_u = dp.species_to_ugm3({'o3': o3_sfc, 'no': no_sfc, 'no2': no2_sfc,
+                             'co': co_sfc}, t2, psfc)
 
 
 # Downloading CETESB data for  model evaluation
@@ -67,7 +69,7 @@ cetesb_pol = dp.download_load_cetesb_pol(cetesb_dom, cetesb_login, cetesb_pass,
 # Sao Paulo local time
 wrf_met = dp.cetesb_from_wrf(cetesb_dom, ( t2, rh2, wind),
                           to_local=True)
-wrf_pol = dp.cetesb_from_wrf(cetesb_dom, ( o3_u, no_u, no2_u, co_sfc),
+wrf_pol = dp.cetesb_from_wrf(cetesb_dom, (pols_u, ),
                           to_local=True)
 
 
@@ -89,23 +91,17 @@ met_global_eval = ms.global_stat(model_met, obs_met, csv=True)
 
 
 # Time series comparison
-for k in model_met:
-    ms.simple_vs_plot(model_met[k], obs_met[k], 't2', '$T2 \; (K)$',
-                      True, '.png')
-    ms.simple_vs_plot(model_met[k], obs_met[k], 'rh2', '$RH2 \; (\%)$',
-                      True, '.png')
-    ms.simple_vs_plot(model_met[k], obs_met[k], 'ws', '$WS10 \; (m/s)$',
-                      True, '.png')
-
-for k in model_pol:
-    ms.simple_vs_plot(model_pol[k], obs_pol[k], 'o3', '$O_3 \; (\mu g / m^3)$',
-                      True, '.png')
-    ms.simple_vs_plot(model_pol[k], obs_pol[k], 'no', '$NO \; (\mu g / m^3)$',
-                      True, '.png')
-    ms.simple_vs_plot(model_pol[k], obs_pol[k], 'no2', '$NO_2 \; (\mu g / m^3)$',
-                      True, '.png')
-    ms.simple_vs_plot(model_pol[k], obs_pol[k], 'co', '$CO \; (ppm)$',
-                      True, '.png')
+met_labels = {'t2': '$T2 \; (K)$',
+              'rh2': '$RH2 \; (\%)$',
+              'ws': '$WS10 \; (m/s)$'}
+pol_labels = {'o3': '$O_3 \; (\mu g / m^3)$',
+              'no': '$NO \; (\mu g / m^3)$',
+              'no2': '$NO_2 \; (\mu g / m^3)$',
+              'co': '$CO \; (ppm)$'}
+# n_workers > 1 uses worker processes, then put the script under
+# if __name__ == '__main__': so workers don't run the extraction again
+ms.batch_plots(model_met, obs_met, met_labels, frmt='.png', n_workers=1)
+ms.batch_plots(model_pol, obs_pol, pol_labels, frmt='.png', n_workers=1)
 
 # Photochemical profile comparison
 
@@ -113,3 +109,8 @@ pin_wrf = model_pol['Pinheiros']
 pin_obs = obs_pol['Pinheiros']
 
 ms.photo_profile_comparison(pin_wrf, pin_obs, save_fig=True, frmt=".png")
+
+# Time and memory of each stage, when run with WRF_SP_EVAL_PROFILE=1
+# or WRF_SP_EVAL_PROFILE=profile.json
+if prof.is_enabled():
+    print(prof.report())
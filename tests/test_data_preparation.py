@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Regression tests of data_preparation station extraction
+"""
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+import wrf_sp_eval.data_preparation as dp
+
+
+def grid_var(name, values):
+    '''
+    wrf.getvar() like DataArray on a 3 x 4 grid
+    '''
+    n_time, ny, nx = values.shape
+    xlat, xlong = np.meshgrid(np.linspace(-24, -23, ny),
+                              np.linspace(-47, -46, nx), indexing='ij')
+    return xr.DataArray(
+        values, name=name, dims=['Time', 'south_north', 'west_east'],
+        coords={'Time': pd.date_range('2018-06-21', periods=n_time,
+                                      freq='h'),
+                'XLAT': (('south_north', 'west_east'), xlat),
+                'XLONG': (('south_north', 'west_east'), xlong)})
+
+
+@pytest.fixture
+def stacked_species():
+    rng = np.random.default_rng(0)
+    shape = (5, 3, 4)
+    t2 = grid_var('T2', 290 + rng.random(shape))
+    psfc = grid_var('PSFC', 92000 + 100 * rng.random(shape))
+    pols = {name: grid_var(name, rng.random(shape))
+            for name in ['o3', 'no', 'no2', 'co']}
+    cetesb_dom = pd.DataFrame({'name': ['A', 'B'], 'code': [1, 2],
+                               'y': [0, 2], 'x': [1, 3]})
+    return (dp.species_to_ugm3(pols, t2, psfc), pols, t2, psfc, cetesb_dom)
+
+
+def test_cetesb_from_wrf_species(stacked_species):
+    pols_u, pols, t2, psfc, cetesb_dom = stacked_species
+    wrf_dic = dp.cetesb_from_wrf(cetesb_dom, (pols_u, ))
+    for i, name in enumerate(cetesb_dom.name):
+        y, x = cetesb_dom.y[i], cetesb_dom.x[i]
+        for pol in ['o3', 'no', 'no2']:
+            expected = dp.ppm_to_ugm3(pols[pol], t2, psfc,
+                                      dp.SPECIES[pol]['M'])
+            np.testing.assert_allclose(
+                wrf_dic[name][pol].values,
+                expected.isel(south_north=y, west_east=x).values)
+        np.testing.assert_allclose(
+            wrf_dic[name]['co'].values,
+            pols['co'].isel(south_north=y, west_east=x).values)
+
+
+def test_wrf_station_retrieve_species(stacked_species):
+    pols_u, pols, t2, psfc, cetesb_dom = stacked_species
+    wrf_sta = dp.wrf_station_retrieve(1, cetesb_dom, pols_u)
+    assert list(wrf_sta.columns) == ['code', 'name', 'o3', 'no', 'no2', 'co']
+    np.testing.assert_allclose(
+        wrf_sta['no2'].values,
+        pols_u.sel(species='no2').isel(south_north=2, west_east=3).values)
+
+
+def test_interpolated_wind_direction_around_north():
+    ny, nx, n_time = 3, 4, 2
+    wspd = np.full((n_time, ny, nx), 5.0)
+    wdir = np.where(np.arange(nx) < 2, 350.0, 10.0) * np.ones((n_time, ny, 1))
+    wind = xr.concat([grid_var('uvmet10_wspd_wdir', wspd),
+                      grid_var('uvmet10_wspd_wdir', wdir)],
+                     dim=pd.Index(['wspd', 'wdir'], name='wspd_wdir'))
+    wind = wind.rename('uvmet10_wspd_wdir')
+    lat = np.linspace(-24, -23, ny)[1]
+    lon = np.linspace(-47, -46, nx)[1:3].mean()
+    cetesb_dom = pd.DataFrame({'name': ['A'], 'code': [1], 'lat': [lat],
+                               'lon': [lon], 'y': [1], 'x': [1]})
+    for method in ['bilinear', 'idw']:
+        wrf_dic = dp.cetesb_from_wrf(cetesb_dom, (wind, ), method=method)
+        wd = wrf_dic['A']['wd'].values
+        # Angular distance from north
+        assert np.all(np.minimum(wd, 360 - wd) <= 10), (method, wd)
+        np.testing.assert_allclose(wrf_dic['A']['ws'].values,
+                                   5 * np.cos(np.deg2rad(10)), rtol=0.02)
+    np.testing.assert_allclose(
+        dp.cetesb_from_wrf(cetesb_dom, (wind, ))['A']['wd'].values, 350)
+
+
+def test_model_eval_setup_missing_hours():
+    date = pd.date_range('2018-06-21', periods=72, freq='h', tz='UTC')
+    model_df = pd.DataFrame({'code': 1, 'name': 'A',
+                             'o3': np.arange(72.0)}, index=date)
+    obs_date = date.tz_convert('America/Sao_Paulo')
+    obs_df = pd.DataFrame({'o3': np.arange(72.0) + 0.5}, index=obs_date)
+    missing = obs_date[30:40]
+    obs_df = obs_df.drop(missing)
+    wrf_dic, cet_dic = dp.model_eval_setup({'A': model_df}, {'A': obs_df},
+                                           date_start='2018-06-22')
+    assert wrf_dic['A'].index[0] == pd.Timestamp('2018-06-22', tz='UTC')
+    assert cet_dic['A'].index.equals(wrf_dic['A'].index)
+    o3 = cet_dic['A'].o3
+    assert o3[missing.tz_convert('UTC')].isna().all()
+    assert o3.notna().sum() == len(o3.index) - len(missing)
+    np.testing.assert_allclose(o3.dropna().values,
+                               wrf_dic['A'].o3[o3.notna()].values + 0.5)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Equivalence tests of model_stats vectorized and mergeable statistics
+against the per-station functions
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+import wrf_sp_eval.model_stats as ms
+
+
+def station_pair(name, n_hours=96, seed=0):
+    '''
+    Model and observation DataFrames of one station, with missing
+    values in both
+    '''
+    rng = np.random.default_rng(seed)
+    date = pd.date_range('2018-06-21', periods=n_hours, freq='h',
+                         tz='America/Sao_Paulo', name='date')
+    obs = pd.DataFrame({'o3': rng.gamma(4, 10, n_hours),
+                        'no2': rng.gamma(3, 15, n_hours),
+                        'wd': rng.uniform(0, 360, n_hours)}, index=date)
+    model = obs * rng.normal(1, 0.3, obs.shape)
+    model['wd'] = (obs.wd + rng.normal(0, 60, n_hours)) % 360
+    obs = obs.mask(rng.random(obs.shape) < 0.15)
+    obs.iloc[-1] = obs.iloc[-1].fillna(1.0)
+    model = model.mask(rng.random(model.shape) < 0.05)
+    model.insert(0, 'name', name)
+    model.insert(0, 'code', seed)
+    return (model, obs)
+
+
+@pytest.fixture
+def network():
+    model_dic = {}
+    obs_dic = {}
+    for i, name in enumerate(['Pinheiros', 'Ibirapuera', 'Santana']):
+        model_dic[name], obs_dic[name] = station_pair(name, seed=i)
+    return (model_dic, obs_dic)
+
+
+def test_wind_dir_diff_opposite_directions():
+    Mi = np.array([0, 180, 90, 270, 45])
+    Oi = np.array([180, 0, 270, 90, 225])
+    np.testing.assert_array_equal(ms.wind_dir_diff_array(Mi, Oi), 180)
+    np.testing.assert_array_equal(ms.wind_dir_diff_array(Oi, Mi), 180)
+
+
+@pytest.mark.parametrize('var', ['o3', 'no2'])
+def test_emery_stats_per_metric_functions(network, var):
+    model_dic, obs_dic = network
+    for k in model_dic:
+        model_df, obs_df = model_dic[k], obs_dic[k]
+        mod, obs = ms.aligned_values(model_df, obs_df, var)
+        stats = ms.emery_stats(mod, obs)
+        r = model_df[var].corr(obs_df[var])
+        expected = {
+            'N': len(ms.complete_cases(model_df, obs_df, var).index),
+            'Om': obs_df[var].mean(),
+            'Mm': model_df[var].mean(),
+            'Ostd': obs_df[var].std(),
+            'Mstd': model_df[var].std(),
+            'MB': ms.mean_bias(model_df, obs_df, var),
+            'ME': ms.mean_gross_error(model_df, obs_df, var),
+            'RMSE': ms.root_mean_square_error(model_df, obs_df, var),
+            'NMB': ms.normalized_mean_bias(model_df, obs_df, var),
+            'NME': ms.normalized_mean_error(model_df, obs_df, var),
+            'R': r,
+            'R2': r**2,
+            'IOA': ms.index_of_aggrement(model_df, obs_df, var),
+            'FAC2': ms.fraction_factor2(model_df, obs_df, var)}
+        for stat, value in expected.items():
+            assert stats[stat] == pytest.approx(value, rel=1e-10), stat
+
+
+def test_emery_stats_no_pairs():
+    stats = ms.emery_stats(np.array([1.0, np.nan]), np.array([np.nan, 2.0]))
+    assert np.isnan(stats['N']) and np.isnan(stats['MB'])
+    assert stats['Om'] == 2.0 and stats['Mm'] == 1.0
+
+
+def test_wind_dir_diff_array_scalar_version():
+    rng = np.random.default_rng(1)
+    Mi = rng.uniform(0, 360, 500).round(1)
+    Oi = rng.uniform(0, 360, 500).round(1)
+    Mi[:5] = Oi[:5]
+    # wind_dir_diff() has no result for opposite directions
+    Oi[np.abs(np.abs(Mi - Oi) - 180) < 1e-9] += 0.5
+    expected = [ms.wind_dir_diff(m, o) for m, o in zip(Mi, Oi)]
+    np.testing.assert_allclose(ms.wind_dir_diff_array(Mi, Oi), expected)
+    np.testing.assert_allclose(
+        ms.wind_dir_diff_array(Mi.reshape(20, 25), Oi.reshape(20, 25)),
+        np.reshape(expected, (20, 25)))
+
+
+STAT_COLUMNS = ['N', 'Om', 'Mm', 'Ostd', 'Mstd', 'MB', 'ME', 'RMSE', 'NMB',
+                'NME', 'R', 'R2', 'IOA', 'FAC2']
+
+
+def station_table(stats):
+    '''
+    all_aqs_all_vars() like table with (aqs, pol) index
+    '''
+    stats = stats.rename_axis('pol').set_index('aqs', append=True)
+    return stats.swaplevel().sort_index()[STAT_COLUMNS].astype(float)
+
+
+def test_stats_from_sums_all_aqs_all_vars(network):
+    model_dic, obs_dic = network
+    expected = station_table(ms.all_aqs_all_vars(model_dic, obs_dic))
+    stats = ms.stats_from_sums(ms.all_aqs_sums(model_dic, obs_dic))
+    stats = stats.sort_index()[STAT_COLUMNS].astype(float)
+    pd.testing.assert_frame_equal(stats, expected, check_names=False,
+                                  rtol=1e-9)
+
+
+def test_global_stat_from_sums(network):
+    model_dic, obs_dic = network
+    expected = ms.global_stat(model_dic, obs_dic)[STAT_COLUMNS]
+    # Exact global IOA needs the network observed mean
+    sums = ms.all_aqs_sums(model_dic, obs_dic)
+    sums = ms.all_aqs_sums(model_dic, obs_dic,
+                           obs_ref=ms.global_obs_mean(sums))
+    stats = ms.global_stat_from_sums(sums)
+    stats = stats.loc[expected.index, STAT_COLUMNS].astype(float)
+    pd.testing.assert_frame_equal(stats, expected.astype(float),
+                                  check_names=False, rtol=1e-9)
+
+
+def test_merge_sums_time_chunks(network):
+    model_dic, obs_dic = network
+    chunks = []
+    for part in [slice(None, 48), slice(48, None)]:
+        chunks.append(ms.all_aqs_sums(
+            {k: df.iloc[part] for k, df in model_dic.items()},
+            {k: df.iloc[part] for k, df in obs_dic.items()}))
+    merged = ms.stats_from_sums(ms.merge_sums(chunks))
+    whole = ms.stats_from_sums(ms.all_aqs_sums(model_dic, obs_dic))
+    # IOA needs one observed mean for the whole period
+    cols = [col for col in STAT_COLUMNS if col != 'IOA']
+    pd.testing.assert_frame_equal(merged[cols], whole[cols], rtol=1e-9)
+
+
+def test_incremental_evaluation_single_batch(network):
+    model_dic, obs_dic = network
+    evaluation = ms.IncrementalEvaluation()
+    n_pairs = 0
+    for end in [30, 70, 96]:
+        n_pairs += evaluation.update(
+            model_dic, {k: df.iloc[:end] for k, df in obs_dic.items()})
+    assert evaluation.update(model_dic, obs_dic) == 0
+
+    # IOA keeps the observed mean of the first update
+    cols = [col for col in STAT_COLUMNS if col != 'IOA']
+    expected = station_table(ms.all_aqs_all_vars(model_dic, obs_dic))
+    stats = station_table(evaluation.station_stats())
+    pd.testing.assert_frame_equal(stats[cols], expected[cols],
+                                  check_names=False, rtol=1e-9)
+    assert n_pairs == expected.N.sum()
+
+    expected = ms.global_stat(model_dic, obs_dic)[cols].astype(float)
+    stats = evaluation.global_stats().loc[expected.index, cols]
+    pd.testing.assert_frame_equal(stats.astype(float), expected,
+                                  check_names=False, rtol=1e-9)
+
+
+def test_incremental_evaluation_first_update_ioa(network):
+    model_dic, obs_dic = network
+    evaluation = ms.IncrementalEvaluation()
+    evaluation.update(model_dic, obs_dic)
+    expected = station_table(ms.all_aqs_all_vars(model_dic, obs_dic))
+    stats = station_table(evaluation.station_stats())
+    np.testing.assert_allclose(stats.IOA, expected.IOA, rtol=1e-9)
+    expected = ms.global_stat(model_dic, obs_dic)
+    stats = evaluation.global_stats().loc[expected.index]
+    np.testing.assert_allclose(stats.IOA.astype(float),
+                               expected.IOA.astype(float), rtol=1e-9)
+
+
+def test_grouped_stats_one_group(network):
+    model_dic, obs_dic = network
+    stats = ms.grouped_stats(model_dic, obs_dic,
+                             by=lambda date: np.zeros(len(date), dtype=int))
+    assert (stats.group == 0).all()
+    stats = stats.set_index(['aqs', 'pol']).sort_index()
+    expected = station_table(ms.all_aqs_all_vars(model_dic, obs_dic))
+    pd.testing.assert_frame_equal(stats[STAT_COLUMNS].astype(float),
+                                  expected, check_names=False, rtol=1e-9)
+
+
+def test_grouped_stats_hour(network):
+    model_dic, obs_dic = network
+    stats = ms.grouped_stats(model_dic, obs_dic, by='hour', var=['o3'])
+    row = stats[(stats.aqs == 'Santana') & (stats.group == 13)].iloc[0]
+    hour = model_dic['Santana'].index.hour == 13
+    expected = ms.all_stats(model_dic['Santana'][hour],
+                            obs_dic['Santana'][hour], 'o3')
+    for stat in STAT_COLUMNS:
+        assert row[stat] == pytest.approx(expected[stat], rel=1e-9,
+                                          nan_ok=True), stat
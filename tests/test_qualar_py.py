@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Regression tests of QUALAR export page parsing
+"""
+
+import numpy as np
+import wrf_sp_eval.qualar_py as qr
+
+
+def data_row(hour, val):
+    return ("<tr><td>A</td><td>1</td><td>P</td><td>01/06/2018</td>"
+            "<td>{:02d}:00</td><td>M</td><td>Pinheiros</td><td>O3</td>"
+            "<td>ug/m3</td><td>{}</td></tr>".format(hour, val))
+
+
+def export_page(rows, tbody=False):
+    header = "<tr><th>Dados</th></tr><tr><th>Rede</th></tr>"
+    if tbody:
+        table = ("<thead>" + header + "</thead><tbody>" + "".join(rows) +
+                 "</tbody>")
+    else:
+        table = header + "".join(rows)
+    return ("<html><body><table id=\"tbl\">" + table +
+            "</table></body></html>").encode('utf-8')
+
+
+def test_empty_value_cell():
+    page = export_page([data_row(1, '1,5'), data_row(2, ''),
+                        data_row(3, '2,5')])
+    dat = qr.qualar_data_frame(page, '01/06/2018', '01/06/2018')
+    np.testing.assert_allclose(dat.val.dropna().values, [1.5, 2.5])
+    assert np.isnan(dat.val['2018-06-01 02:00'])
+
+
+def test_tbody_page():
+    page = export_page([data_row(1, '1,5'), data_row(24, '2,5')],
+                       tbody=True)
+    dat = qr.qualar_data_frame(page, '01/06/2018', '01/06/2018')
+    np.testing.assert_allclose(dat.val.dropna().values, [1.5, 2.5])
+    assert dat.val['2018-06-02 00:00'] == 2.5
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the station Dataset time zone handling
+"""
+
+import numpy as np
+import pandas as pd
+import wrf_sp_eval.station_data as sd
+
+
+def station_dic(tz):
+    date = pd.date_range('2018-06-21', periods=6, freq='h', tz=tz,
+                         name='date')
+    return {'Pinheiros': pd.DataFrame({'code': 99, 'o3': np.arange(6.)},
+                                      index=date)}
+
+
+def test_time_zone_from_data():
+    model_ds = sd.dict_to_dataset(station_dic('UTC'))
+    assert model_ds.attrs['time_zone'] == 'UTC'
+    obs_ds = sd.dict_to_dataset(station_dic('America/Sao_Paulo'))
+    assert obs_ds.attrs['time_zone'] == 'America/Sao_Paulo'
+    naive = sd.dict_to_dataset(station_dic(None))
+    assert naive.attrs['time_zone'] == sd.LOCAL_TIME_ZONE
+
+
+def test_missing_time_zone_is_utc():
+    model_dic = station_dic('UTC')
+    model_ds = sd.dict_to_dataset(model_dic)
+    del model_ds.attrs['time_zone']
+    back = sd.dataset_to_dict(model_ds)['Pinheiros']
+    assert str(back.index.tz) == 'UTC'
+    assert back.index.equals(model_dic['Pinheiros'].index)
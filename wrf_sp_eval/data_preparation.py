@@ -9,12 +9,19 @@ Created on Wed Jun 10 16:22:58 2020
 
 
 import os
-import pickle
-import wrf as wrf
+import glob
+import hashlib
+import functools
+import numpy as np
 import pandas as pd
 import xarray as xr
+from netCDF4 import Dataset
+from scipy.spatial import cKDTree
 import wrf_sp_eval.qualar_py as qr
+import wrf_sp_eval.station_data as sd
+import wrf_sp_eval.profiling as prof
 
+@prof.profiled('ppm_to_ugm3')
 def ppm_to_ugm3(pol, t2, psfc, M):
     '''
     Transform concentration from ppm to ugm⁻3
@@ -41,16 +48,332 @@ def ppm_to_ugm3(pol, t2, psfc, M):
     return(pol_ugm3)
 
 
-def stations_in_domains(station_file, wrfout, wrfvar):
+# Model species: wrfout variable, molecular mass (g/mol), units of
+# CETESB data and QUALAR parameter code. Species with M None are
+# already in ugm-3 in wrfout.
+SPECIES = {
+    'o3': {'wrf': 'o3', 'M': 48, 'units': 'ugm3', 'code': 63},
+    'no': {'wrf': 'no', 'M': 30, 'units': 'ugm3', 'code': 17},
+    'no2': {'wrf': 'no2', 'M': 46, 'units': 'ugm3', 'code': 15},
+    'co': {'wrf': 'co', 'M': 28, 'units': 'ppm', 'code': 16},
+    'so2': {'wrf': 'so2', 'M': 64, 'units': 'ugm3', 'code': 13},
+    'pm10': {'wrf': 'PM10', 'M': None, 'units': 'ugm3', 'code': 12},
+    'pm25': {'wrf': 'PM2_5_DRY', 'M': None, 'units': 'ugm3', 'code': 57}
+}
+
+
+def species_masses(species):
+    '''
+    Molecular mass to use with ppm_to_ugm3() for each species, None
+    when no conversion is needed (CETESB data in ppm, or model
+    already in ugm-3)
+
+    Parameters
+    ----------
+    species : list of str
+        Keys of SPECIES.
+
+    Returns
+    -------
+    masses : dict
+        Molecular mass or None of each species.
+
+    '''
+    masses = {}
+    for name in species:
+        if name not in SPECIES:
+            raise ValueError(name + " is not in SPECIES")
+        convert = (SPECIES[name]['units'] == 'ugm3' and
+                   SPECIES[name]['M'] is not None)
+        masses[name] = SPECIES[name]['M'] if convert else None
+    return masses
+
+
+@prof.profiled('species_to_ugm3')
+def species_to_ugm3(pols, t2, psfc, masses=None):
+    '''
+    Transform several species to CETESB units at once. Species are
+    stacked along a species dimension and converted in one broadcasted
+    operation sharing psfc / (R * t2).
+
+    Parameters
+    ----------
+    pols : dict
+        Species name (SPECIES key) and its xarray DataArray.
+    t2 : xarray DataArray
+        Temperature at 2m (K).
+    psfc : xarray DataArray
+        Surface pressure (Pa).
+    masses : dict, optional
+        Molecular mass or None of each species. The default is None
+        (from SPECIES, see species_masses()).
+
+    Returns
+    -------
+    pols_u : xarray DataArray
+        Species with a species dimension.
+
+    '''
+    if masses is None:
+        masses = species_masses(pols)
+    R = 8.3142 # J/K mol
+    names = list(pols)
+    stacked = xr.concat([pols[name] for name in names],
+                        dim=pd.Index(names, name='species'))
+    M = np.array([masses[name] or 0 for name in names], dtype=float)
+    keep = np.array([masses[name] is None for name in names], dtype=float)
+    M = xr.DataArray(M, dims='species', coords={'species': names})
+    keep = xr.DataArray(keep, dims='species', coords={'species': names})
+    pols_u = stacked * (M * (psfc / (R * t2)) + keep)
+    return(pols_u.rename('species'))
+
+
+# Global attributes that define the domain projection and position
+DOMAIN_ATTRS = ['MAP_PROJ', 'TRUELAT1', 'TRUELAT2', 'STAND_LON',
+                'MOAD_CEN_LAT', 'CEN_LAT', 'CEN_LON', 'POLE_LAT',
+                'POLE_LON', 'DX', 'DY']
+
+# WRF earth radius (km)
+EARTH_RADIUS = 6370.0
+
+
+def wrfout_attrs(wrfout):
+    '''
+    Global attributes of a wrfout opened with netCDF4 or xarray
+    '''
+    if isinstance(wrfout, xr.Dataset):
+        return wrfout.attrs
+    return {attr: wrfout.getncattr(attr) for attr in wrfout.ncattrs()}
+
+
+def wrfout_latlon(wrfout):
+    '''
+    XLAT and XLONG of the first time as 2-D numpy arrays
+
+    Parameters
+    ----------
+    wrfout : netCDF4 Dataset or xarray Dataset
+        wrfout file or a subset of it, only XLAT and XLONG are needed.
+
+    Returns
+    -------
+    xlat, xlong : numpy array
+        (south_north, west_east) latitude and longitude.
+
+    '''
+    if isinstance(wrfout, xr.Dataset):
+        xlat = wrfout['XLAT'].values
+        xlong = wrfout['XLONG'].values
+    else:
+        xlat = wrfout.variables['XLAT'][:]
+        xlong = wrfout.variables['XLONG'][:]
+    xlat = np.asarray(xlat, dtype=float)
+    xlong = np.asarray(xlong, dtype=float)
+    if xlat.ndim == 3:
+        xlat = xlat[0]
+        xlong = xlong[0]
+    return (xlat, xlong)
+
+
+def latlon_to_xyz(lat, lon):
+    '''
+    Unit sphere cartesian coordinates, last axis is x, y, z
+    '''
+    lat = np.deg2rad(np.asarray(lat, dtype=float))
+    lon = np.deg2rad(np.asarray(lon, dtype=float))
+    return np.stack([np.cos(lat) * np.cos(lon),
+                     np.cos(lat) * np.sin(lon),
+                     np.sin(lat)], axis=-1)
+
+
+class GridLocator:
+    '''
+    Nearest grid cell of many points using a KD-tree over the model
+    XLAT and XLONG. It doesn't need the projection attributes, so it
+    works with any curvilinear grid or wrfout subset.
+
+    Parameters
+    ----------
+    xlat : numpy array
+        (south_north, west_east) latitude.
+    xlong : numpy array
+        (south_north, west_east) longitude.
+    '''
+
+    def __init__(self, xlat, xlong):
+        xlat = np.asarray(xlat, dtype=float)
+        xlong = np.asarray(xlong, dtype=float)
+        self.shape = xlat.shape
+        self.xyz = latlon_to_xyz(xlat, xlong)
+        self.tree = cKDTree(self.xyz.reshape(-1, 3))
+
+    def query(self, lat, lon):
+        '''
+        Locate points in the grid
+
+        Parameters
+        ----------
+        lat : array like
+            Points latitude.
+        lon : array like
+            Points longitude.
+
+        Returns
+        -------
+        y : numpy array
+            south_north index of the nearest cell.
+        x : numpy array
+            west_east index of the nearest cell.
+        distance : numpy array
+            Distance to the nearest cell center (km).
+        in_domain : numpy array
+            True when the point is inside the domain, i.e. inside the
+            grid cells area (half a cell beyond edge cell centers).
+
+        '''
+        ny, nx = self.shape
+        pts = latlon_to_xyz(lat, lon)
+        chord, cell = self.tree.query(pts)
+        y, x = np.unravel_index(cell, self.shape)
+        distance = 2 * EARTH_RADIUS * np.arcsin(np.minimum(chord / 2, 1))
+
+        # Position in grid units from the local grid axes, to tell
+        # points beyond the domain edge from points in edge cells
+        xp, xm = np.minimum(x + 1, nx - 1), np.maximum(x - 1, 0)
+        yp, ym = np.minimum(y + 1, ny - 1), np.maximum(y - 1, 0)
+        e_x = ((self.xyz[y, xp] - self.xyz[y, xm]) /
+               np.maximum(xp - xm, 1)[:, None])
+        e_y = ((self.xyz[yp, x] - self.xyz[ym, x]) /
+               np.maximum(yp - ym, 1)[:, None])
+        d = pts - self.xyz[y, x]
+        a11 = (e_x * e_x).sum(axis=1)
+        a12 = (e_x * e_y).sum(axis=1)
+        a22 = (e_y * e_y).sum(axis=1)
+        b1 = (e_x * d).sum(axis=1)
+        b2 = (e_y * d).sum(axis=1)
+        det = a11 * a22 - a12 ** 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fx = x + np.where(det > 0, (a22 * b1 - a12 * b2) / det, 0)
+            fy = y + np.where(det > 0, (a11 * b2 - a12 * b1) / det, 0)
+        in_domain = ((fx >= -0.5) & (fx <= nx - 0.5) &
+                     (fy >= -0.5) & (fy <= ny - 0.5))
+        return (y, x, distance, in_domain)
+
+
+def domain_key(station_file, wrfout, nx, ny, method='ll_to_xy'):
+    '''
+    Hash of the domain projection, grid size and station file, used
+    to name the station index cache
+
+    Parameters
+    ----------
+    station_file : str
+        csv file with name, code, lat and lon columns.
+    wrfout : netCDF4 Dataset
+        wrfout file.
+    nx : int
+        Number of west_east points.
+    ny : int
+        Number of south_north points.
+    method : str, optional
+        Station locating method, 'kdtree' also hashes XLAT and XLONG.
+        The default is 'll_to_xy'.
+
+    Returns
+    -------
+    key : str
+        sha1 hex digest.
+
+    '''
+    key = hashlib.sha1()
+    attrs = wrfout_attrs(wrfout)
+    for attr in DOMAIN_ATTRS:
+        if attr in attrs:
+            key.update("{}={};".format(attr, attrs[attr]).encode())
+    key.update("nx={};ny={};method={};".format(nx, ny, method).encode())
+    if method == 'kdtree':
+        for coord in wrfout_latlon(wrfout):
+            key.update(coord.tobytes())
+    with open(station_file, 'rb') as stations:
+        key.update(stations.read())
+    return key.hexdigest()
+
+
+@prof.profiled('stations_in_domains')
+def stations_in_domains(station_file, wrfout, wrfvar=None, cache_dir=None,
+                        method='ll_to_xy'):
+    '''
+    Select the stations inside the wrfout domain and add their
+    grid indices
+
+    Parameters
+    ----------
+    station_file : str
+        csv file with name, code, lat and lon columns.
+    wrfout : netCDF4 Dataset
+        wrfout file. With method='kdtree' it can also be an xarray
+        Dataset with only XLAT and XLONG.
+    wrfvar : xarray DataArray, optional
+        wrfout extracted variable used to get the grid size. If None,
+        the grid size is read from wrfout dimensions, so no variable
+        needs to be extracted first. The default is None.
+    cache_dir : str, optional
+        Folder to keep the station indices of each domain. Files are
+        named after domain_key(), so the same domain and station file
+        skip ll_to_xy, and a changed domain or station file gets a new
+        entry. The default is None (no cache).
+    method : str, optional
+        'll_to_xy' uses wrf.ll_to_xy() and the projection attributes,
+        'kdtree' the nearest XLAT/XLONG cell with GridLocator, which
+        also adds a distance (km) column. The default is 'll_to_xy'.
+
+    Returns
+    -------
+    station_dom : pandas DataFrame
+        Stations inside the domain with x and y columns.
+
+    '''
+    if wrfvar is not None:
+        nx = wrfvar.west_east.shape[0]
+        ny = wrfvar.south_north.shape[0]
+    elif isinstance(wrfout, xr.Dataset):
+        nx = wrfout.sizes['west_east']
+        ny = wrfout.sizes['south_north']
+    else:
+        nx = len(wrfout.dimensions['west_east'])
+        ny = len(wrfout.dimensions['south_north'])
+
+    if cache_dir is not None:
+        file_name = os.path.join(
+            cache_dir, "stations_" +
+            domain_key(station_file, wrfout, nx, ny, method) + ".csv")
+        if os.path.exists(file_name):
+            return pd.read_csv(file_name, index_col=0)
+
     station = pd.read_csv(station_file)
-    station_xy = wrf.ll_to_xy(wrfout,
-                              longitude=station.lon,
-                              latitude=station.lat)
-    station['x'] = station_xy[0]
-    station['y'] = station_xy[1]
-    filter_dom = ((station.x >0) & (station.x < wrfvar.west_east.shape[0]) & 
-                  (station.y > 0) & (station.y < wrfvar.south_north.shape[0]))
-    station_dom = station[filter_dom]
+    if method == 'kdtree':
+        locator = GridLocator(*wrfout_latlon(wrfout))
+        y, x, distance, in_domain = locator.query(station.lat, station.lon)
+        station['x'] = x
+        station['y'] = y
+        station['distance'] = distance
+        station_dom = station[in_domain]
+    else:
+        # wrf-python is only needed here, the rest of the module works
+        # without it
+        import wrf
+        station_xy = wrf.ll_to_xy(wrfout,
+                                  longitude=station.lon,
+                                  latitude=station.lat)
+        station['x'] = station_xy[0]
+        station['y'] = station_xy[1]
+        filter_dom = ((station.x >= 0) & (station.x < nx) &
+                      (station.y >= 0) & (station.y < ny))
+        station_dom = station[filter_dom]
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        station_dom.to_csv(file_name)
     return station_dom
 
 
@@ -108,7 +431,11 @@ def wrf_station_retrieve(i, cetesb_dom, *args, to_local=False,
     wrf_sta['code'] = cetesb_dom.code.values[i]
     wrf_sta['name'] = cetesb_dom.name.values[i]
     for arg in args:
-        if arg.name == "uvmet10_wspd_wdir":
+        if 'species' in arg.dims:
+            for name in arg.species.values:
+                wrf_sta[str(name)] = wrf_var_retrieve(arg.sel(species=name),
+                                                      cetesb_dom, i).values
+        elif arg.name == "uvmet10_wspd_wdir":
             wrf_sta['ws'] = wrf_var_retrieve(arg.sel(wspd_wdir="wspd"),
                                              cetesb_dom, i).values
             wrf_sta['wd'] = wrf_var_retrieve(arg.sel(wspd_wdir="wdir"),
@@ -136,7 +463,479 @@ def wrf_station_retrieve(i, cetesb_dom, *args, to_local=False,
 
 
 
-def cetesb_from_wrf(cetesb_dom, args, to_local=False):
+def station_weights(cetesb_dom, xlat, xlong, method='bilinear', power=2):
+    '''
+    Interpolation weights of the grid cells around each station,
+    computed once per domain and applied to all variables and times
+    by wrf_stations_block()
+
+    Parameters
+    ----------
+    cetesb_dom : pandas DataFrame
+        Information of stations (with lat, lon, x and y columns).
+    xlat : xarray DataArray or numpy array
+        XLAT of the domain (south_north, west_east), the first time
+        is used if it has a Time dimension.
+    xlong : xarray DataArray or numpy array
+        XLONG of the domain.
+    method : str, optional
+        'bilinear' uses the four cells around the station, 'idw' the
+        inverse distance of the 3x3 cells around the station nearest
+        cell. The default is 'bilinear'.
+    power : int, optional
+        Power of the inverse distance when method='idw'. The default
+        is 2.
+
+    Returns
+    -------
+    weights : xarray Dataset
+        y, x and weight with (station, neighbor) dimensions.
+
+    '''
+    xlat = np.asarray(xlat, dtype=float)
+    xlong = np.asarray(xlong, dtype=float)
+    if xlat.ndim == 3:
+        xlat = xlat[0]
+        xlong = xlong[0]
+    ny, nx = xlat.shape
+    lat = cetesb_dom.lat.values.astype(float)
+    lon = cetesb_dom.lon.values.astype(float)
+    j0 = cetesb_dom.y.values.astype(int)
+    i0 = cetesb_dom.x.values.astype(int)
+
+    if method == 'bilinear':
+        # Fractional grid position from the local grid jacobian
+        ip, im = np.minimum(i0 + 1, nx - 1), np.maximum(i0 - 1, 0)
+        jp, jm = np.minimum(j0 + 1, ny - 1), np.maximum(j0 - 1, 0)
+        dlon_di = (xlong[j0, ip] - xlong[j0, im]) / (ip - im)
+        dlat_di = (xlat[j0, ip] - xlat[j0, im]) / (ip - im)
+        dlon_dj = (xlong[jp, i0] - xlong[jm, i0]) / (jp - jm)
+        dlat_dj = (xlat[jp, i0] - xlat[jm, i0]) / (jp - jm)
+        dlon = lon - xlong[j0, i0]
+        dlat = lat - xlat[j0, i0]
+        det = dlon_di * dlat_dj - dlon_dj * dlat_di
+        fi = i0 + (dlon * dlat_dj - dlon_dj * dlat) / det
+        fj = j0 + (dlon_di * dlat - dlon * dlat_di) / det
+
+        ia = np.clip(np.floor(fi).astype(int), 0, nx - 2)
+        ja = np.clip(np.floor(fj).astype(int), 0, ny - 2)
+        wx = np.clip(fi - ia, 0, 1)
+        wy = np.clip(fj - ja, 0, 1)
+        y = np.stack([ja, ja, ja + 1, ja + 1], axis=1)
+        x = np.stack([ia, ia + 1, ia, ia + 1], axis=1)
+        weight = np.stack([(1 - wy) * (1 - wx), (1 - wy) * wx,
+                           wy * (1 - wx), wy * wx], axis=1)
+    elif method == 'idw':
+        dj, di = np.meshgrid([-1, 0, 1], [-1, 0, 1], indexing='ij')
+        y = j0[:, None] + dj.ravel()
+        x = i0[:, None] + di.ravel()
+        inside = (y >= 0) & (y < ny) & (x >= 0) & (x < nx)
+        y = np.clip(y, 0, ny - 1)
+        x = np.clip(x, 0, nx - 1)
+        dist = np.hypot((xlong[y, x] - lon[:, None]) *
+                        np.cos(np.deg2rad(lat[:, None])),
+                        xlat[y, x] - lat[:, None])
+        with np.errstate(divide='ignore'):
+            weight = np.where(inside, 1 / dist ** power, 0)
+        on_cell = inside & (dist == 0)
+        weight = np.where(on_cell.any(axis=1)[:, None],
+                          on_cell.astype(float), weight)
+    else:
+        raise ValueError("method must be 'bilinear' or 'idw'")
+
+    weight = weight / weight.sum(axis=1, keepdims=True)
+    weights = xr.Dataset(
+        {'y': (('station', 'neighbor'), y),
+         'x': (('station', 'neighbor'), x),
+         'weight': (('station', 'neighbor'), weight)},
+        coords={'station': cetesb_dom.name.values})
+    return(weights)
+
+
+def station_points(var, cetesb_dom, weights=None):
+    '''
+    Values of var at stations, from the nearest cell or interpolated
+    with station_weights()
+
+    Parameters
+    ----------
+    var : xarray DataArray
+        Variable with south_north and west_east dimensions.
+    cetesb_dom : pandas DataFrame
+        Information of stations (with x and y columns).
+    weights : xarray Dataset, optional
+        Output of station_weights(). The default is None (nearest
+        cell).
+
+    Returns
+    -------
+    pts : xarray DataArray
+        var with a station dimension instead of the grid dimensions.
+
+    '''
+    if weights is None:
+        y = xr.DataArray(cetesb_dom.y.values, dims='station')
+        x = xr.DataArray(cetesb_dom.x.values, dims='station')
+        return var.isel(south_north=y, west_east=x)
+    y = xr.DataArray(weights['y'].values, dims=('station', 'neighbor'))
+    x = xr.DataArray(weights['x'].values, dims=('station', 'neighbor'))
+    pts = var.isel(south_north=y, west_east=x)
+    weight = xr.DataArray(weights['weight'].values,
+                          dims=('station', 'neighbor'))
+    return xr.dot(pts, weight, dims='neighbor')
+
+
+def station_wind(wind, cetesb_dom, weights=None):
+    '''
+    Wind speed and direction at stations. With interpolation weights
+    the wind components are interpolated and speed and direction are
+    computed from them, so directions around north are not averaged
+    as numbers (350 and 10 degrees give 0, not 180).
+
+    Parameters
+    ----------
+    wind : xarray DataArray
+        wrf.getvar() uvmet10_wspd_wdir.
+    cetesb_dom : pandas DataFrame
+        Information of stations (with x and y columns).
+    weights : xarray Dataset, optional
+        Output of station_weights(). The default is None (nearest
+        cell).
+
+    Returns
+    -------
+    ws, wd : xarray DataArray
+        Wind speed and direction with a station dimension.
+
+    '''
+    wspd = wind.sel(wspd_wdir="wspd", drop=True)
+    wdir = wind.sel(wspd_wdir="wdir", drop=True)
+    if weights is None:
+        return (station_points(wspd, cetesb_dom),
+                station_points(wdir, cetesb_dom))
+    # Components of the wind, wdir is where the wind comes from
+    wdir_rad = np.deg2rad(wdir)
+    u = station_points(-wspd * np.sin(wdir_rad), cetesb_dom, weights)
+    v = station_points(-wspd * np.cos(wdir_rad), cetesb_dom, weights)
+    ws = np.sqrt(u ** 2 + v ** 2)
+    wd = (270 - np.arctan2(v, u) * 180 / np.pi) % 360
+    return (ws, wd)
+
+
+def wrf_stations_block(cetesb_dom, args, weights=None):
+    '''
+    Extract all wrf parameters for all stations in cetesb_dom
+    with one vectorized indexing per variable
+
+    Parameters
+    ----------
+    cetesb_dom : pandas DataFrame
+        Information of stations (with x and y columns).
+    args : tuple of xarray DataArray
+        wrfout extracted variables. Variables with a species
+        dimension (species_to_ugm3()) give one variable per species.
+    weights : xarray Dataset, optional
+        Interpolation weights from station_weights(). The default is
+        None (nearest cell).
+
+    Returns
+    -------
+    block : xarray DataArray
+        Array with (station, Time, variable) dimensions. Station
+        code is kept as a station coordinate.
+
+    '''
+    if isinstance(args, xr.DataArray):
+        args = (args,)
+
+    var_names = []
+    var_values = []
+    for arg in args:
+        if arg.name == "uvmet10_wspd_wdir":
+            var_names += ['ws', 'wd']
+            for pts in station_wind(arg, cetesb_dom, weights):
+                var_values.append(pts.transpose('station', 'Time').values)
+            continue
+        pts = station_points(arg, cetesb_dom, weights)
+        if 'species' in arg.dims:
+            for name in arg.species.values:
+                var_names.append(str(name))
+                var_values.append(pts.sel(species=name)
+                                  .transpose('station', 'Time').values)
+        else:
+            var_names.append(arg.name.lower())
+            var_values.append(pts.transpose('station', 'Time').values)
+
+    block = stack_station_block(cetesb_dom, args[0].Time.values,
+                                var_names, var_values)
+    return(block)
+
+
+def stack_station_block(cetesb_dom, times, var_names, var_values):
+    '''
+    Build a (station, Time, variable) DataArray from station x time
+    arrays
+
+    Parameters
+    ----------
+    cetesb_dom : pandas DataFrame
+        Information of stations.
+    times : numpy array
+        Model times (UTC).
+    var_names : list of str
+        Variable names.
+    var_values : list of numpy array
+        One (station, Time) array per variable.
+
+    Returns
+    -------
+    block : xarray DataArray
+        Array with (station, Time, variable) dimensions.
+
+    '''
+    block = xr.DataArray(
+        np.stack(var_values, axis=-1),
+        dims=('station', 'Time', 'variable'),
+        coords={'station': cetesb_dom.name.values,
+                'code': ('station', cetesb_dom.code.values),
+                'Time': times,
+                'variable': var_names})
+    return(block)
+
+
+def wrfout_times(wrf_ds):
+    '''
+    Read model times from wrfout Times variable
+
+    Parameters
+    ----------
+    wrf_ds : xarray Dataset
+        wrfout opened with xarray.
+
+    Returns
+    -------
+    times : numpy array
+        datetime64 model times (UTC).
+
+    '''
+    times = wrf_ds['Times'].values
+    if times.ndim == 2:
+        times = np.array([b''.join(row) for row in times])
+    if times.dtype.kind == 'S':
+        times = np.char.decode(times, 'ascii')
+    times = pd.to_datetime(times, format='%Y-%m-%d_%H:%M:%S')
+    return(times.values)
+
+
+@prof.profiled('wrf_points_retrieve')
+def wrf_points_retrieve(wrfout_file, cetesb_dom, var_names, level=0,
+                        weights=None):
+    '''
+    Read wrfout variables only at station cells. Only the selected
+    model level and the station columns are loaded from disk, the
+    full 3-D grid is never materialized. Use stations_in_domains()
+    first to get station indices.
+
+    Parameters
+    ----------
+    wrfout_file : str
+        wrfout file path.
+    cetesb_dom : pandas DataFrame
+        Information of stations (with x and y columns).
+    var_names : list of str
+        Names of wrfout variables (e.g. ['T2', 'PSFC', 'o3', 'no']).
+        Only variables stored in wrfout can be read, diagnostics like
+        rh2 or uvmet10_wspd_wdir need wrf.getvar().
+    level : int, optional
+        bottom_top level for 3-D variables. The default is 0 (surface).
+    weights : xarray Dataset, optional
+        Interpolation weights from station_weights(). The default is
+        None (nearest cell).
+
+    Returns
+    -------
+    block : xarray DataArray
+        Array with (station, Time, variable) dimensions, use
+        block_to_dict() to get the cetesb_from_wrf() dictionary.
+
+    '''
+    with xr.open_dataset(wrfout_file, decode_times=False,
+                         cache=False) as wrf_ds:
+        times = wrfout_times(wrf_ds)
+        var_values = []
+        for var_name in var_names:
+            if var_name not in wrf_ds.variables:
+                raise ValueError(var_name + " is not a wrfout variable, "
+                                 "use wrf.getvar() and cetesb_from_wrf()")
+            var = wrf_ds[var_name]
+            if 'bottom_top' in var.dims:
+                var = var.isel(bottom_top=level)
+            pts = station_points(var, cetesb_dom, weights)
+            var_values.append(pts.transpose('station', 'Time').values)
+
+    block = stack_station_block(cetesb_dom, times,
+                                [var_name.lower() for var_name in var_names],
+                                var_values)
+    return(block)
+
+
+# wrfout fields needed by point_diagnostics()
+MET_FIELDS = ['T2', 'PSFC', 'Q2', 'U10', 'V10', 'COSALPHA', 'SINALPHA']
+
+
+def point_diagnostics(block, pols=None):
+    '''
+    Compute rh2, earth-rotated ws and wd, and pollutant
+    concentrations in ugm-3 from raw wrfout fields at stations,
+    instead of computing them on the full grid
+
+    Parameters
+    ----------
+    block : xarray DataArray
+        wrf_points_retrieve() output with t2, psfc, q2, u10, v10,
+        cosalpha, sinalpha and the pollutant variables.
+    pols : list or dict, optional
+        SPECIES names, e.g. ['o3', 'no', 'co'], or molecular mass of
+        each pollutant, e.g. {'o3': 48, 'no': 30, 'co': None}.
+        Pollutants with None are kept in ppm. The default is None.
+
+    Returns
+    -------
+    block : xarray DataArray
+        Array with (station, Time, variable) dimensions with t2, rh2,
+        ws, wd and pollutant variables.
+
+    '''
+    if pols is None:
+        pols = {}
+    if not isinstance(pols, dict):
+        pols = species_masses(pols)
+    t2 = block.sel(variable='t2', drop=True)
+    psfc = block.sel(variable='psfc', drop=True)
+    q2 = block.sel(variable='q2', drop=True)
+    u10 = block.sel(variable='u10', drop=True)
+    v10 = block.sel(variable='v10', drop=True)
+    cosalpha = block.sel(variable='cosalpha', drop=True)
+    sinalpha = block.sel(variable='sinalpha', drop=True)
+
+    # Same as wrf-python rh2
+    es = 6.112 * np.exp(17.67 * (t2 - 273.15) / (t2 - 29.65))
+    qvs = 0.622 * es / (0.01 * psfc - (1 - 0.622) * es)
+    rh2 = 100 * (q2 / qvs).clip(0, 1)
+
+    # Grid to earth winds
+    u = u10 * cosalpha - v10 * sinalpha
+    v = v10 * cosalpha + u10 * sinalpha
+    ws = np.sqrt(u ** 2 + v ** 2)
+    wd = (270 - np.arctan2(v, u) * 180 / np.pi) % 360
+
+    var_names = ['t2', 'rh2', 'ws', 'wd']
+    var_values = [t2, rh2, ws, wd]
+    if pols:
+        pols_u = species_to_ugm3(
+            {pol: block.sel(variable=pol, drop=True) for pol in pols},
+            t2, psfc, pols)
+        var_names += list(pols)
+        var_values += [pols_u.sel(species=pol, drop=True) for pol in pols]
+    diag = xr.concat(var_values, dim='variable')
+    diag = diag.assign_coords(variable=var_names)
+    return(diag.transpose('station', 'Time', 'variable'))
+
+
+@prof.profiled('wrf_points_diagnostics')
+def wrf_points_diagnostics(wrfout_file, cetesb_dom, pols=None, level=0,
+                           weights=None):
+    '''
+    Read only the needed wrfout fields at station cells and compute
+    t2, rh2, ws, wd and pollutants in ugm-3 there. Equivalent to
+    wrf.getvar() rh2 and uvmet10_wspd_wdir and ppm_to_ugm3() with
+    cetesb_from_wrf(), without full grid temporaries.
+
+    Parameters
+    ----------
+    wrfout_file : str
+        wrfout file path.
+    cetesb_dom : pandas DataFrame
+        Information of stations (with x and y columns).
+    pols : list or dict, optional
+        SPECIES names, e.g. ['o3', 'no', 'no2', 'co'], or molecular
+        mass of each pollutant, e.g. {'o3': 48, 'no': 30, 'no2': 46,
+        'co': None}. Pollutants with None are kept in ppm. The default
+        is None (only meteorology).
+    level : int, optional
+        bottom_top level for pollutants. The default is 0 (surface).
+    weights : xarray Dataset, optional
+        Interpolation weights from station_weights(). The default is
+        None (nearest cell).
+
+    Returns
+    -------
+    block : xarray DataArray
+        Array with (station, Time, variable) dimensions, use
+        block_to_dict() to get the cetesb_from_wrf() dictionary.
+
+    '''
+    if pols is None:
+        pols = {}
+    if not isinstance(pols, dict):
+        pols = species_masses(pols)
+    wrf_names = [SPECIES[pol]['wrf'] if pol in SPECIES else pol
+                 for pol in pols]
+    raw = wrf_points_retrieve(wrfout_file, cetesb_dom,
+                              MET_FIELDS + wrf_names, level=level,
+                              weights=weights)
+    raw = raw.assign_coords(variable=[field.lower() for field in MET_FIELDS]
+                            + list(pols))
+    return point_diagnostics(raw, pols)
+
+
+def block_to_dict(block, to_local=False, time_zone="America/Sao_Paulo"):
+    '''
+    Split a (station, Time, variable) block into a dictionary of
+    station DataFrames, as returned by cetesb_from_wrf()
+
+    Parameters
+    ----------
+    block : xarray DataArray
+        Output of wrf_stations_block().
+    to_local : Bool, optional
+        Change the time zone to local. The default is False.
+    time_zone : str, optional
+        if to_local=true, transform date to local_time. The default is "America/Sao_Paulo".
+
+    Returns
+    -------
+    Dicitionary, each key is a station.
+
+    '''
+    dates = pd.DatetimeIndex(block['Time'].values, name='date').tz_localize('UTC')
+    if to_local:
+        dates = dates.tz_convert(time_zone)
+
+    var_names = list(block['variable'].values)
+    values = block.values
+    wrf_cetesb = {}
+    for i, (name, code) in enumerate(zip(block['station'].values,
+                                         block['code'].values)):
+        wrf_sta = pd.DataFrame(values[i], index=dates, columns=var_names)
+        wrf_sta.insert(0, 'name', name)
+        wrf_sta.insert(0, 'code', code)
+        wrf_cetesb[name] = wrf_sta
+    return(wrf_cetesb)
+
+
+def domain_weights(cetesb_dom, args, method):
+    '''
+    station_weights() from XLAT and XLONG coordinates of the first
+    extracted variable
+    '''
+    first = args if isinstance(args, xr.DataArray) else args[0]
+    return station_weights(cetesb_dom, first.XLAT, first.XLONG, method)
+
+
+@prof.profiled('cetesb_from_wrf')
+def cetesb_from_wrf(cetesb_dom, args, to_local=False, method='nearest',
+                    weights=None, as_dataset=False):
     '''
     Extract all wrf parameter from station in cetesb_dom
 
@@ -148,18 +947,88 @@ def cetesb_from_wrf(cetesb_dom, args, to_local=False):
         wrfout extracted variables..
     to_local : TYPE, optional
         Add local time. The default is False.
+    method : str, optional
+        'nearest' cell, or 'bilinear' or 'idw' interpolation (see
+        station_weights()) using XLAT and XLONG of the first variable.
+        The default is 'nearest'.
+    weights : xarray Dataset, optional
+        Precomputed station_weights(), to reuse them between calls.
+        The default is None.
+    as_dataset : Bool, optional
+        Return the station Dataset (see station_data), dates in UTC.
+        The default is False.
 
     Returns
     -------
-    Dicitionary, each key is a station.
+    Dicitionary, each key is a station, or xarray Dataset.
 
     '''
-    wrf_cetesb ={}
-    for i in range(len(cetesb_dom.index)):
-        wrf_cetesb[cetesb_dom.name.iloc[i]] = wrf_station_retrieve(i, 
-                                                                   cetesb_dom, 
-                                                                   *args, 
-                                                                   to_local=to_local)
+    if weights is None and method != 'nearest':
+        weights = domain_weights(cetesb_dom, args, method)
+    block = wrf_stations_block(cetesb_dom, args, weights)
+    if as_dataset:
+        return sd.block_to_dataset(block)
+    wrf_cetesb = block_to_dict(block, to_local=to_local)
+    return(wrf_cetesb)
+    
+    
+
+@prof.profiled('cetesb_from_wrf_files')
+def cetesb_from_wrf_files(cetesb_dom, wrf_files, extract_vars,
+                          to_local=False, method='nearest', weights=None,
+                          as_dataset=False):
+    '''
+    Extract all wrf parameter from station in cetesb_dom from a series
+    of wrfout files. Files are opened one at a time, so memory is
+    bounded by one file.
+
+    Parameters
+    ----------
+    cetesb_dom : pandas DataFrame
+        Information of stations.
+    wrf_files : str or list of str
+        wrfout file names or glob pattern (e.g. "wrfout_d02_*").
+    extract_vars : function
+        Function that takes an opened wrfout (netCDF4 Dataset) and
+        returns the tuple of extracted variables to pass to
+        cetesb_from_wrf().
+    to_local : Bool, optional
+        Add local time. The default is False.
+    method : str, optional
+        'nearest', 'bilinear' or 'idw', see cetesb_from_wrf(). Weights
+        are computed from the first file and reused for the others.
+        The default is 'nearest'.
+    weights : xarray Dataset, optional
+        Precomputed station_weights(). The default is None.
+    as_dataset : Bool, optional
+        Return the station Dataset (see station_data), dates in UTC.
+        The default is False.
+
+    Returns
+    -------
+    Dicitionary, each key is a station, or xarray Dataset.
+
+    '''
+    if isinstance(wrf_files, str):
+        wrf_files = sorted(glob.glob(wrf_files))
+
+    blocks = []
+    for wrf_file in wrf_files:
+        wrfout = Dataset(wrf_file)
+        try:
+            wrf_vars = extract_vars(wrfout)
+            if weights is None and method != 'nearest':
+                weights = domain_weights(cetesb_dom, wrf_vars, method)
+            blocks.append(wrf_stations_block(cetesb_dom, wrf_vars,
+                                             weights))
+        finally:
+            wrfout.close()
+
+    block = xr.concat(blocks, dim='Time')
+    block = block.isel(Time=~block.get_index('Time').duplicated())
+    if as_dataset:
+        return sd.block_to_dataset(block)
+    wrf_cetesb = block_to_dict(block, to_local=to_local)
     return(wrf_cetesb)
     
     
@@ -193,6 +1062,158 @@ def qualar_st_end_time(wrf_var):
 
 
 
+def dataset_eval_setup(wrf_ds, cet_ds, date_start):
+    '''
+    model_eval_setup() for station Datasets (see station_data). A
+    dictionary is transformed to a Dataset.
+
+    Parameters
+    ----------
+    wrf_ds : xarray Dataset or dict
+        Model station data.
+    cet_ds : xarray Dataset or dict
+        Observed station data.
+    date_start : string
+        Date after spin-up in %Y-%m-%d, local time of wrf_ds.
+
+    Returns
+    -------
+    wrf_ds : xarray Dataset
+        Model data after spin-up.
+    cet_ds : xarray Dataset
+        Observations at model stations and dates, NaN where there is
+        no observation.
+
+    '''
+    if not isinstance(wrf_ds, xr.Dataset):
+        wrf_ds = sd.dict_to_dataset(wrf_ds)
+    if not isinstance(cet_ds, xr.Dataset):
+        cet_ds = sd.dict_to_dataset(cet_ds)
+    time_zone = wrf_ds.attrs.get('time_zone', 'UTC')
+    start = (pd.Timestamp(date_start).tz_localize(time_zone)
+             .tz_convert('UTC').tz_localize(None))
+    wrf_ds = wrf_ds.sel(date=slice(start, None))
+    cet_ds = (cet_ds.drop_vars('code')
+              .reindex(station=wrf_ds.station, date=wrf_ds.date)
+              .assign_coords(code=wrf_ds.code))
+    return (wrf_ds, cet_ds)
+
+
+def hours_since_epoch(dates):
+    '''
+    Integer hours since 1970-01-01 UTC
+
+    Parameters
+    ----------
+    dates : pandas DatetimeIndex
+        Dates, tz-aware dates are transformed to UTC first.
+
+    Returns
+    -------
+    numpy array
+        int64 hours.
+
+    '''
+    if not isinstance(dates, pd.DatetimeIndex):
+        dates = pd.DatetimeIndex(dates)
+    # asi8 of tz-aware dates is already UTC
+    return np.floor_divide(dates.asi8, 3600 * 10**9)
+
+
+def hour_positions(obs_hours, model_hours):
+    '''
+    Row of each model hour in the observations. Complete hourly
+    observations use index arithmetic, otherwise searchsorted.
+
+    Parameters
+    ----------
+    obs_hours : numpy array
+        Observation integer hours.
+    model_hours : numpy array
+        Model integer hours.
+
+    Returns
+    -------
+    rows : numpy array
+        Observation row of each model hour.
+    found : numpy array
+        False where the observations don't have the model hour.
+
+    '''
+    n_obs = obs_hours.size
+    if n_obs == 0:
+        return (np.zeros(model_hours.size, dtype=int),
+                np.zeros(model_hours.size, dtype=bool))
+    if obs_hours[-1] - obs_hours[0] == n_obs - 1 and \
+            np.all(obs_hours[1:] > obs_hours[:-1]):
+        rows = model_hours - obs_hours[0]
+        found = (rows >= 0) & (rows < n_obs)
+        return (np.clip(rows, 0, n_obs - 1), found)
+    if np.all(obs_hours[1:] > obs_hours[:-1]):
+        order = np.arange(n_obs)
+    else:
+        order = np.argsort(obs_hours, kind='stable')
+    sorted_hours = obs_hours[order]
+    pos = np.minimum(np.searchsorted(sorted_hours, model_hours), n_obs - 1)
+    found = sorted_hours[pos] == model_hours
+    return (order[pos], found)
+
+
+def take_hours(obs_df, rows, found, index):
+    '''
+    Observation rows at model dates, NaN rows where not found
+    '''
+    if len(obs_df.index) == 0:
+        return obs_df.reindex(index)
+    if all(dtype.kind == 'f' for dtype in obs_df.dtypes):
+        values = obs_df.to_numpy()[rows]
+        values[~found] = np.nan
+        return pd.DataFrame(values, index=index, columns=obs_df.columns)
+    aligned = obs_df.iloc[rows]
+    if not found.all():
+        aligned = aligned.mask(np.broadcast_to(~found[:, None],
+                                               aligned.shape))
+    return aligned.set_axis(index)
+
+
+def align_hours(model_dic, obs_dic, model_hours=None):
+    '''
+    Observations at model hours for all stations. Dates are compared
+    as integer UTC hours instead of tz-aware timestamps.
+
+    Parameters
+    ----------
+    model_dic : dict
+        Dict with stations wrf ouput DataFrames.
+    obs_dic : dict
+        Dict with observation DataFrames.
+    model_hours : dict, optional
+        hours_since_epoch() of each model DataFrame. The default is
+        None.
+
+    Returns
+    -------
+    aligned : dict
+        Observation DataFrames with the model dates, NaN where there
+        is no observation.
+
+    '''
+    aligned = {}
+    for aqs in obs_dic:
+        if aqs not in model_dic:
+            continue
+        if model_hours is None or aqs not in model_hours:
+            hours = hours_since_epoch(model_dic[aqs].index)
+        else:
+            hours = model_hours[aqs]
+        rows, found = hour_positions(hours_since_epoch(obs_dic[aqs].index),
+                                     hours)
+        aligned[aqs] = take_hours(obs_dic[aqs], rows, found,
+                                  model_dic[aqs].index)
+    return aligned
+
+
+@prof.profiled('model_eval_setup')
 def model_eval_setup(wrf_dic, cet_dic, date_start):
     '''
     Prepare model output dictionary and obsrevation dictionary, 
@@ -216,17 +1237,128 @@ def model_eval_setup(wrf_dic, cet_dic, date_start):
         Observation dictitonary ready to model evaluation.
 
     '''
+    if isinstance(wrf_dic, xr.Dataset) or isinstance(cet_dic, xr.Dataset):
+        return dataset_eval_setup(wrf_dic, cet_dic, date_start)
+    model_hours = {}
     for aqs in wrf_dic:
-        wrf_dic[aqs] = wrf_dic[aqs][date_start: ]
-    
-    for aqs in cet_dic:        
-        cet_dic[aqs] = (cet_dic[aqs].loc[wrf_dic[aqs].index])
-        
+        hours = hours_since_epoch(wrf_dic[aqs].index)
+        start = hours_since_epoch(
+            [pd.Timestamp(date_start, tz=wrf_dic[aqs].index.tz)])[0]
+        if np.all(hours[1:] >= hours[:-1]):
+            after = slice(np.searchsorted(hours, start), None)
+            wrf_dic[aqs] = wrf_dic[aqs].iloc[after]
+        else:
+            after = hours >= start
+            wrf_dic[aqs] = wrf_dic[aqs][after]
+        model_hours[aqs] = hours[after]
+
+    # Missing observation hours are NaN
+    cet_dic.update(align_hours(wrf_dic, cet_dic, model_hours))
     return (wrf_dic, cet_dic)
 
 
+def qualar_day_runs(days):
+    '''
+    Split days into runs of consecutive days
+
+    Parameters
+    ----------
+    days : pandas DatetimeIndex
+        Sorted days.
+
+    Returns
+    -------
+    list of tuple
+        (first day, last day) of each run.
+
+    '''
+    run_id = (days.to_series().diff() != pd.Timedelta(days=1)).cumsum()
+    return [(run.iloc[0], run.iloc[-1]) for _, run in
+            days.to_series().groupby(run_id.values)]
+
+
+def cetesb_cached_download(cetesb_login, cetesb_pass, start, end,
+                           parameter, station, client=None,
+                           cache_dir="qualar_cache"):
+    '''
+    Same as qualar_py.cetesb_data_download() but keeping a cache per
+    parameter, station and day. Only the missing days are
+    downloaded, in as few requests as possible. Days from today
+    on are not kept as downloaded, because QUALAR data is not
+    complete yet.
+
+    Parameters
+    ----------
+    cetesb_login : str
+        Cetesb qualAr user name.
+    cetesb_pass : str
+        Cetesb qualAr password.
+    start : str
+        Start date in %d/%m/%Y.
+    end : str
+        End date in %d/%m/%Y.
+    parameter : int
+        QUALAR parameter code.
+    station : int
+        AQS code.
+    client : qualar_py.QualarClient, optional
+        Logged QUALAR session. The default is None.
+    cache_dir : str, optional
+        Cache folder. The default is "qualar_cache".
+
+    Returns
+    -------
+    pandas DataFrame
+        Hourly 'val' column, with the same index as
+        cetesb_data_download().
+
+    '''
+    file_name = os.path.join(cache_dir,
+                             str(parameter) + '_' + str(station) + '.nc')
+    if os.path.exists(file_name):
+        cache_ds = xr.load_dataset(file_name)
+        cache = {'val': cache_ds.val.to_series(),
+                 'days': pd.DatetimeIndex(cache_ds.day.values)}
+    else:
+        cache = {'val': pd.Series(dtype=float),
+                 'days': pd.DatetimeIndex([])}
+
+    days = pd.date_range(pd.to_datetime(start, format='%d/%m/%Y'),
+                         pd.to_datetime(end, format='%d/%m/%Y'), freq='D')
+    missing = days.difference(cache['days'])
+    if len(missing) > 0:
+        vals = [cache['val']]
+        for day1, day2 in qualar_day_runs(missing):
+            dat = qr.cetesb_data_download(cetesb_login, cetesb_pass,
+                                          day1.strftime('%d/%m/%Y'),
+                                          day2.strftime('%d/%m/%Y'),
+                                          parameter, station, client=client)
+            # A QUALAR day goes from 01:00 to 24:00
+            vals.append(dat.val.astype(float)[
+                day1 + pd.Timedelta(hours=1):day2 + pd.Timedelta(days=1)])
+        val = pd.concat(vals)
+        cache['val'] = val[~val.index.duplicated(keep='last')].sort_index()
+        today = pd.Timestamp.now(tz='America/Sao_Paulo').normalize()
+        cache['days'] = cache['days'].union(
+            missing[missing < today.tz_localize(None)])
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_ds = xr.Dataset(
+            {'val': ('date', cache['val'].values)},
+            coords={'date': cache['val'].index.values,
+                    'day': cache['days'].values})
+        cache_ds.to_netcdf(file_name)
+
+    index = pd.date_range(days[0], days[-1] + pd.Timedelta(days=1), freq='h')
+    val = cache['val'].reindex(index)
+    # First hour belongs to the day before start, as in QUALAR download
+    val.iloc[0] = np.nan
+    return pd.DataFrame({'val': val})
+
+
+@prof.profiled('download_load_cetesb_met')
 def download_load_cetesb_met(cetesb_dom, cetesb_login, 
-                             cetesb_pass, start, end):
+                             cetesb_pass, start, end, n_workers=1,
+                             cache_dir="qualar_cache", as_dataset=False):
     '''
     Download and save cetesb meteorological data for 
     wrfoutput times 
@@ -243,6 +1375,15 @@ def download_load_cetesb_met(cetesb_dom, cetesb_login,
         Start date to download, use qualar_st_end_tim().
     end : str
         End date to download, use qualar_st_end_tim().
+    n_workers : int, optional
+        Number of concurrent QUALAR downloads. The default is 1.
+    cache_dir : str, optional
+        Folder of the downloaded data cache, only days not in
+        the cache are downloaded. The default is "qualar_cache".
+
+    as_dataset : Bool, optional
+        Return the station Dataset (see station_data). The default
+        is False.
 
     Returns
     -------
@@ -251,28 +1392,23 @@ def download_load_cetesb_met(cetesb_dom, cetesb_login,
         per station.
 
     '''
-    file_name = ("met_" + start.replace("/", "_") + 
-                 '-' + end.replace("/", "_") + ".pkl")
-    if os.path.exists(file_name):
-        print("There is downloaded data, now opening")
-        a_dict = open(file_name, "rb")
-        cet_dict = pickle.load(a_dict)
-        a_dict.close()
-    else:
-        print("No data available, now downloading ")
-        cet_dict = {}
-        for code in cetesb_dom.code:
-            cet_dict[cetesb_dom.name[cetesb_dom.code == code].values[0]] = (
-                qr.all_met(cetesb_login, cetesb_pass, start, end, 
-                           code, in_k = True))
-        a_dict = open(file_name, "wb")
-        pickle.dump(cet_dict, a_dict)
-        a_dict.close()
+    download = functools.partial(cetesb_cached_download, cache_dir=cache_dir)
+    cet_code = qr.all_met_stations(cetesb_login, cetesb_pass, start, end,
+                                   list(cetesb_dom.code), in_k=True,
+                                   n_workers=n_workers, download=download)
+    cet_dict = {}
+    for code in cetesb_dom.code:
+        cet_dict[cetesb_dom.name[cetesb_dom.code == code].values[0]] = (
+            cet_code[code])
+    if as_dataset:
+        return sd.dict_to_dataset(cet_dict, cetesb_dom=cetesb_dom)
     return cet_dict
 
 
+@prof.profiled('download_load_cetesb_pol')
 def download_load_cetesb_pol(cetesb_dom, cetesb_login, 
-                             cetesb_pass, start, end):
+                             cetesb_pass, start, end, n_workers=1,
+                             cache_dir="qualar_cache", as_dataset=False):
     '''
     Download and save cetesb criteria pollutant data for 
     wrfoutput times 
@@ -289,6 +1425,15 @@ def download_load_cetesb_pol(cetesb_dom, cetesb_login,
         Start date to download, use qualar_st_end_tim().
     end : str
         End date to download, use qualar_st_end_tim().
+    n_workers : int, optional
+        Number of concurrent QUALAR downloads. The default is 1.
+    cache_dir : str, optional
+        Folder of the downloaded data cache, only days not in
+        the cache are downloaded. The default is "qualar_cache".
+
+    as_dataset : Bool, optional
+        Return the station Dataset (see station_data). The default
+        is False.
 
     Returns
     -------
@@ -297,26 +1442,96 @@ def download_load_cetesb_pol(cetesb_dom, cetesb_login,
         station
 
     '''
-    file_name = ("pol_" + start.replace("/", "_") + 
-                 '-' + end.replace("/", "_") + ".pkl")
-    if os.path.exists(file_name):
-        print("There is downloaded data, now opening")
-        a_dict = open(file_name, "rb")
-        cet_dict = pickle.load(a_dict)
-        a_dict.close()
-    else:
-        print("No data available, now downloading")
-        cet_dict = {}
-        for code in cetesb_dom.code:
-            cet_dict[cetesb_dom.name[cetesb_dom.code == code].values[0]] = (
-                qr.all_photo(cetesb_login, cetesb_pass, start, end, code))
-        a_dict = open(file_name, "wb")
-        pickle.dump(cet_dict, a_dict)
-        a_dict.close()
+    download = functools.partial(cetesb_cached_download, cache_dir=cache_dir)
+    cet_code = qr.all_photo_stations(cetesb_login, cetesb_pass, start,
+                                     end, list(cetesb_dom.code),
+                                     n_workers=n_workers, download=download)
+    cet_dict = {}
+    for code in cetesb_dom.code:
+        cet_dict[cetesb_dom.name[cetesb_dom.code == code].values[0]] = (
+            cet_code[code])
+    if as_dataset:
+        return sd.dict_to_dataset(cet_dict, cetesb_dom=cetesb_dom)
     return cet_dict
 
+def save_station_data(station_dic, file_name, cetesb_dom=None,
+                      time_zone=None):
+    '''
+    Save a dictionary of station DataFrames in a netCDF file, so
+    stations, parameters or periods can be read without loading the
+    rest (see load_station_data()).
+
+    Parameters
+    ----------
+    station_dic : dict
+        Dictionary containing data frames with station data.
+    file_name : str
+        netCDF file name.
+    cetesb_dom : pandas DataFrame, optional
+        Information of stations, to keep station codes. The default
+        is None.
+    time_zone : str, optional
+        Time zone of the data, saved as the time_zone attribute. The
+        default is None, the time zone of the DataFrames dates (see
+        station_data.dict_to_dataset()).
+
+    Returns
+    -------
+    None.
+
+    '''
+    (sd.dict_to_dataset(station_dic, cetesb_dom=cetesb_dom,
+                        time_zone=time_zone)
+     .to_netcdf(file_name))
+
+
+def load_station_data(file_name, stations=None, variables=None,
+                      start=None, end=None, to_local=True, as_dataset=False):
+    '''
+    Read stations data saved with save_station_data(). Only the
+    selected stations, parameters and period are read from disk.
+
+    Parameters
+    ----------
+    file_name : str
+        netCDF file name.
+    stations : list, optional
+        Station names or codes. The default is None (all stations).
+    variables : list of str, optional
+        Parameters to read. The default is None (all parameters).
+    start : str, optional
+        First date (UTC) in %Y-%m-%d. The default is None.
+    end : str, optional
+        Last date (UTC) in %Y-%m-%d. The default is None.
+    to_local : Bool, optional
+        Transform dates to the saved time zone, otherwise keep UTC.
+        Files without time_zone attribute are read in UTC. The default
+        is True.
+    as_dataset : Bool, optional
+        Return the station Dataset (see station_data) instead of the
+        dictionary. The default is False.
+
+    Returns
+    -------
+    station_dic : dict or xarray Dataset
+        Dictionary containing data frames with station data.
+
+    '''
+    with xr.open_dataset(file_name, cache=False) as station_ds:
+        if stations is not None:
+            in_sel = (station_ds.station.isin(stations) |
+                      station_ds.code.isin(stations)).values
+            station_ds = station_ds.isel(station=np.where(in_sel)[0])
+        if variables is not None:
+            station_ds = station_ds[variables]
+        station_ds = station_ds.sel(date=slice(start, end)).load()
+    if as_dataset:
+        return station_ds
+    return sd.dataset_to_dict(station_ds, to_local=to_local)
+
+
 def read_aqs_obs(code, sep, ident='_obs.csv', to_local=True, 
-                 time_zone="America/Sao_Paulo"):
+                 time_zone="America/Sao_Paulo", store=None):
     '''
     Read AQS information from csv filrs
 
@@ -332,6 +1547,9 @@ def read_aqs_obs(code, sep, ident='_obs.csv', to_local=True,
         Localize date time zone. The default is True.
     time_zone : str, optional
         AQS date timezone. The default is "America/Sao_Paulo".
+    store : str, optional
+        netCDF file from save_station_data(). If given, the AQS is
+        read from it instead of the csv file. The default is None.
 
     Returns
     -------
@@ -339,6 +1557,13 @@ def read_aqs_obs(code, sep, ident='_obs.csv', to_local=True,
         Data frame with aqs data.
 
     '''
+    if store is not None:
+        station_dic = load_station_data(store, stations=[code],
+                                        to_local=to_local)
+        if len(station_dic) == 0:
+            raise ValueError("AQS " + str(code) + " is not in " + str(store))
+        aqs = list(station_dic.values())[0]
+        return aqs
     file_name = str(code) + ident
     aqs = pd.read_csv(file_name, sep=sep)
     aqs['date'] = pd.to_datetime(aqs['date'],
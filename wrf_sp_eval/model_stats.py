@@ -7,9 +7,15 @@ Created on Sun May 24 17:23:49 2020
 """
 
 
+import os
 import numpy as np
 import pandas as pd
+import xarray as xr
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from concurrent.futures import ProcessPoolExecutor
+import wrf_sp_eval.station_data as sd
+import wrf_sp_eval.profiling as prof
 
 def complete_cases(model_df, obs_df, var):
     '''
@@ -232,6 +238,42 @@ def wind_dir_diff(Mi, Oi):
     
     return(ans)
     
+def wind_dir_diff_array(Mi, Oi):
+    '''
+    Vectorized version of wind_dir_diff(). Works element-wise on
+    arrays of any shape (e.g. station x time matrices).
+    Based on Reboredo et al. 2015. Opposite directions (a difference
+    of 180 in both ways) are always +180, so the result does not
+    depend on the argument order.
+
+    Parameters
+    ----------
+    Mi : numpy.ndarray
+        Model wind direction.
+    Oi : numpy.ndarray
+        Observed wind direction, broadcastable against Mi.
+
+    Returns
+    -------
+    wd_dif : numpy.ndarray
+        Wind difference, NaN where Mi or Oi is NaN.
+
+    '''
+    Mi = np.asarray(Mi, dtype=float)
+    Oi = np.asarray(Oi, dtype=float)
+    wd_dif = Mi - Oi
+    ans = np.select(
+        [Mi < Oi, Mi > Oi, Mi == Oi],
+        [np.where(np.abs(wd_dif) < np.abs(360 + wd_dif),
+                  wd_dif, 360 + wd_dif),
+         np.where(np.abs(wd_dif) < np.abs(wd_dif - 360),
+                  wd_dif, wd_dif - 360),
+         0.0],
+        default=np.nan)
+    ans = np.where(ans == -180, 180.0, ans)
+    return(ans)
+
+
 def wind_dir_mb(model_df, obs_df, wd_name='wd'):
     '''
     Calculates wind direction mean bias based in 
@@ -259,8 +301,7 @@ def wind_dir_mb(model_df, obs_df, wd_name='wd'):
     if wd_df.empty:
         wd_mb = np.nan
     else:
-        dif = wd_df.apply(lambda row: wind_dir_diff(row['mi'], row['oi']),
-                      axis=1)
+        dif = wind_dir_diff_array(wd_df.mi.values, wd_df.oi.values)
         wd_mb = dif.mean()    
     return wd_mb
 
@@ -291,16 +332,125 @@ def wind_dir_mage(model_df, obs_df, wd_name='wd'):
     if wd_df.empty:
         mage = np.nan
     else:
-        dif = wd_df.apply(lambda row: wind_dir_diff(row['mi'], row['oi']),
-                      axis=1)
-        mage = dif.abs().mean()
+        dif = wind_dir_diff_array(wd_df.mi.values, wd_df.oi.values)
+        mage = np.abs(dif).mean()
     return mage
 
 
+def aligned_values(model_df, obs_df, var, return_index=False):
+    '''
+    Align model and observation columns once and return them
+    as float numpy arrays sharing the same index
+
+    Parameters
+    ----------
+    model_df : pandas DataFrame
+        DataFrame with model output.
+    obs_df : pandas DataFrame
+        DataFrame with observation.
+    var : str
+        Name of variable.
+    return_index : Bool, optional
+        Also return the aligned index. The default is False.
+
+    Returns
+    -------
+    mod : numpy.ndarray
+        Model values.
+    obs : numpy.ndarray
+        Observed values, NaN where there is no observation.
+    index : pandas Index
+        Only if return_index=True.
+
+    '''
+    mod = model_df[var]
+    obs = obs_df[var]
+    if not mod.index.equals(obs.index):
+        mod, obs = mod.align(obs, join='outer')
+    if return_index:
+        return (mod.to_numpy(dtype=float), obs.to_numpy(dtype=float),
+                mod.index)
+    return (mod.to_numpy(dtype=float), obs.to_numpy(dtype=float))
+
+
+def emery_stats(mod, obs):
+    '''
+    Calculates recommended statistics from Emery et al. (2017)
+    in a single pass over aligned numpy arrays
+
+    Parameters
+    ----------
+    mod : numpy.ndarray
+        Model values.
+    obs : numpy.ndarray
+        Observed values aligned with mod.
+
+    Returns
+    -------
+    results : dict
+        N, Model and Obs means and std, MB, ME, RMSE, NMB, NME, R, R2,
+        IOA and FAC2.
+
+    '''
+    mod_ok = ~np.isnan(mod)
+    obs_ok = ~np.isnan(obs)
+    cc = mod_ok & obs_ok
+    m = mod[cc]
+    o = obs[cc]
+    n = m.size
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mod_all = mod[mod_ok]
+        obs_all = obs[obs_ok]
+        results = {
+            'N': n if n > 0 else np.nan,
+            'Om': obs_all.mean() if obs_all.size else np.nan,
+            'Mm': mod_all.mean() if mod_all.size else np.nan,
+            'Ostd': obs_all.std(ddof=1) if obs_all.size > 1 else np.nan,
+            'Mstd': mod_all.std(ddof=1) if mod_all.size > 1 else np.nan}
+
+        if n == 0:
+            results.update({'MB': np.nan, 'ME': np.nan, 'RMSE': np.nan,
+                            'NMB': np.nan, 'NME': np.nan, 'R': np.nan,
+                            'R2': np.nan, 'IOA': np.nan, 'FAC2': np.nan})
+            return results
+
+        dif = m - o
+        abs_dif = np.abs(dif)
+        o_sum = o.sum()
+        o_mean = o_sum / n
+        m_mean = m.mean()
+        sq_sum = (dif**2).sum()
+
+        m_anom = m - m_mean
+        o_anom = o - o_mean
+        if n > 1:
+            r = ((m_anom * o_anom).sum() /
+                 np.sqrt((m_anom**2).sum() * (o_anom**2).sum()))
+        else:
+            r = np.nan
+
+        ratio = m / o
+        results.update({
+            'MB': m_mean - o_mean,
+            'ME': abs_dif.mean(),
+            'RMSE': (sq_sum / n)**0.5,
+            'NMB': dif.sum() / o_sum * 100,
+            'NME': abs_dif.sum() / o_sum * 100,
+            'R': r,
+            'R2': r**2,
+            'IOA': 1 - sq_sum / ((np.abs(m - o_mean) +
+                                  np.abs(o_anom))**2).sum(),
+            'FAC2': ((ratio >= 0.5) & (ratio <= 2.0)).sum() / n})
+    return results
+
+
 def all_stats(model_df, obs_df, var, to_df=False):
     '''
     Calculates recommended statistics from Emery et al. (2017)
 
+    Model and observation are aligned only once, see emery_stats().
+
     Parameters
     ----------
     model_df : pandas DataFrame
@@ -318,35 +468,20 @@ def all_stats(model_df, obs_df, var, to_df=False):
         MB, RMSE, NMB, NME, R, Model and Obs means and std.
 
     '''
-    N_df = complete_cases(model_df, obs_df, var)
-    if N_df.empty:
-        N = np.nan
-    else:
-        N = len(N_df.index)
+    mod, obs = aligned_values(model_df, obs_df, var)
 
     if var == 'wd':
+        dif = wind_dir_diff_array(mod, obs)
+        dif = dif[~np.isnan(dif)]
+        N = dif.size
         results = {
-            'N': N,
-            'MB': wind_dir_mb(model_df, obs_df),
-            'ME': wind_dir_mage(model_df, obs_df),
+            'N': N if N > 0 else np.nan,
+            'MB': dif.mean() if N > 0 else np.nan,
+            'ME': np.abs(dif).mean() if N > 0 else np.nan,
             'aqs': model_df.name.unique()[0]}
     else:
-        results = {
-            'N': N,
-            'Om': obs_df[var].mean(),
-            'Mm': model_df[var].mean(),
-            'Ostd': obs_df[var].std(),
-            'Mstd': model_df[var].std(),
-            'MB': mean_bias(model_df, obs_df, var),
-            'ME': mean_gross_error(model_df, obs_df, var),
-            'RMSE': root_mean_square_error(model_df, obs_df, var),
-            'NMB': normalized_mean_bias(model_df, obs_df, var),
-            'NME': normalized_mean_error(model_df, obs_df, var),
-            'R': model_df[var].corr(obs_df[var].astype(float)),
-            'R2': (model_df[var].corr(obs_df[var].astype(float)))**2,
-            'IOA': index_of_aggrement(model_df, obs_df, var), 
-            'FAC2': fraction_factor2(model_df, obs_df, var),
-            'aqs': model_df.name.unique()[0]}
+        results = emery_stats(mod, obs)
+        results['aqs'] = model_df.name.unique()[0]
     
     if to_df:
         results = pd.DataFrame(results, index=[var])
@@ -415,6 +550,7 @@ def some_vars_stats_per_station(model_df, obs_df, var, to_df=False):
 
 
 
+@prof.profiled('all_aqs_all_vars')
 def all_aqs_all_vars(model_dic, obs_dic, to_df=True, 
                      sort_pol = False, csv = False):
     '''
@@ -423,9 +559,9 @@ def all_aqs_all_vars(model_dic, obs_dic, to_df=True,
 
     Parameters
     ----------
-    model_dic : dict
+    model_dic : dict or xarray Dataset
         Dictionaryy containing data frames with station data from model.
-    obs_dic : dict
+    obs_dic : dict or xarray Dataset
         Dictionaryy containing data frames with station data from aqs.
     to_df : bool, optional
         Return a data frame. The default is True.
@@ -440,11 +576,15 @@ def all_aqs_all_vars(model_dic, obs_dic, to_df=True,
         All statistic for all variaables for all aqs.
 
     '''
+    model_dic = sd.as_station_dict(model_dic)
+    obs_dic = sd.as_station_dict(obs_dic)
     result = {}
     for k in model_dic:
-        result[k] = all_var_stats_per_station(model_dic[k],
-                                               obs_dic[k],
-                                               to_df=to_df)
+        with prof.stage('station_stats', station=k,
+                        rows=len(model_dic[k].index)):
+            result[k] = all_var_stats_per_station(model_dic[k],
+                                                   obs_dic[k],
+                                                   to_df=to_df)
     if to_df:
         result = pd.concat(result.values())
         if sort_pol:
@@ -455,6 +595,7 @@ def all_aqs_all_vars(model_dic, obs_dic, to_df=True,
         
     return result
 
+@prof.profiled('all_aqs_some_vars')
 def all_aqs_some_vars(model_dic, obs_dic, var, to_df=True, 
                      sort_pol = False, csv = False):
     '''
@@ -463,9 +604,9 @@ def all_aqs_some_vars(model_dic, obs_dic, var, to_df=True,
 
     Parameters
     ----------
-    model_dic : dict
+    model_dic : dict or xarray Dataset
         Dictionaryy containing data frames with station data from model.
-    obs_dic : dict
+    obs_dic : dict or xarray Dataset
         Dictionaryy containing data frames with station data from aqs.
     to_df : bool, optional
         Return a data frame. The default is True.
@@ -480,6 +621,8 @@ def all_aqs_some_vars(model_dic, obs_dic, var, to_df=True,
         All statistic for all variaables for all aqs.
 
     '''
+    model_dic = sd.as_station_dict(model_dic)
+    obs_dic = sd.as_station_dict(obs_dic)
     result = {}
     for k in model_dic:
         result[k] = some_vars_stats_per_station(model_dic[k],
@@ -495,15 +638,16 @@ def all_aqs_some_vars(model_dic, obs_dic, var, to_df=True,
         
     return result
 
+@prof.profiled('global_stat')
 def global_stat(model_dic, obs_dic, csv=False):
     '''
     Calculates the global statistics  
 
     Parameters
     ----------
-    model_dic : dict
+    model_dic : dict or xarray Dataset
         Dictionary containing data frames with station data from model.
-    obs_dic : dict
+    obs_dic : dict or xarray Dataset
         Dictionary containing data frames with station data from aqs.
     csv : bool, optional
         Export the value as csv. The default is False.
@@ -514,6 +658,8 @@ def global_stat(model_dic, obs_dic, csv=False):
         Contain global statistics.
 
     '''
+    model_dic = sd.as_station_dict(model_dic)
+    obs_dic = sd.as_station_dict(obs_dic)
     model_df = pd.concat(model_dic)
     obs_df =pd.concat(obs_dic)
     
@@ -531,9 +677,9 @@ def global_stat_some_vars(model_dic, obs_dic, var, csv=False):
 
     Parameters
     ----------
-    model_dic : dict
+    model_dic : dict or xarray Dataset
         Dictionary containing data frames with station data from model.
-    obs_dic : dict
+    obs_dic : dict or xarray Dataset
         Dictionary containing data frames with station data from aqs.
     csv : bool, optional
         Export the value as csv. The default is False.
@@ -544,6 +690,8 @@ def global_stat_some_vars(model_dic, obs_dic, var, csv=False):
         Contain global statistics.
 
     '''
+    model_dic = sd.as_station_dict(model_dic)
+    obs_dic = sd.as_station_dict(obs_dic)
     model_df = pd.concat(model_dic)
     obs_df =pd.concat(obs_dic)
     
@@ -555,6 +703,570 @@ def global_stat_some_vars(model_dic, obs_dic, var, csv=False):
     return stats
 
 
+# Sufficient statistics: sums that can be merged across stations,
+# time chunks or processes, see stat_sums() and stats_from_sums()
+
+SUM_COLUMNS = ['n', 'sum_m', 'sum_o', 'sum_mm', 'sum_oo', 'sum_mo',
+               'sum_dif', 'sum_abs', 'sum_sq', 'fac2',
+               'n_m_all', 'sum_m_all', 'sum_mm_all',
+               'n_o_all', 'sum_o_all', 'sum_oo_all', 'ioa_den']
+
+
+def stat_sums(mod, obs, wind_dir=False, obs_ref=None, net_ref=None):
+    '''
+    Sufficient statistics of aligned model and observation arrays
+
+    Parameters
+    ----------
+    mod : numpy.ndarray
+        Model values.
+    obs : numpy.ndarray
+        Observed values aligned with mod.
+    wind_dir : Bool, optional
+        Use wind direction difference (Reboredo et al. 2015) for
+        sum_dif and sum_abs. The default is False.
+    obs_ref : float, optional
+        Observed mean used for IOA denominator. IOA from the sums is
+        exact only when obs_ref is the mean of the merged observations
+        (e.g. from a previous pass). The default is None, which uses
+        the mean of these observations.
+    net_ref : float, optional
+        Second observed mean (e.g. the network one) for an extra
+        ioa_den_net sum. The default is None.
+
+    Returns
+    -------
+    sums : dict
+        SUM_COLUMNS and ioa_ref (and ioa_den_net).
+
+    '''
+    sums = group_stat_sums(mod, obs, np.zeros(np.size(mod), dtype=int), 1,
+                           wind_dir=wind_dir, obs_ref=obs_ref,
+                           net_ref=net_ref)
+    return {col: val[0] for col, val in sums.items()}
+
+
+def group_stat_sums(mod, obs, group, n_groups, wind_dir=False,
+                    obs_ref=None, net_ref=None):
+    '''
+    Sufficient statistics of aligned model and observation arrays
+    for several groups at once (one np.bincount per sum)
+
+    Parameters
+    ----------
+    mod : numpy.ndarray
+        Model values.
+    obs : numpy.ndarray
+        Observed values aligned with mod.
+    group : numpy.ndarray
+        Group number (0 to n_groups - 1) of each value.
+    n_groups : int
+        Number of groups.
+    wind_dir : Bool, optional
+        Use wind direction difference. The default is False.
+    obs_ref : float or numpy.ndarray, optional
+        Observed mean used for IOA denominator, one per group. The
+        default is None, which uses the mean of each group.
+    net_ref : float, optional
+        Second observed mean for an extra IOA denominator, ioa_den_net,
+        so station and network IOA come from one pass. The default is
+        None.
+
+    Returns
+    -------
+    sums : dict
+        SUM_COLUMNS and ioa_ref (and ioa_den_net) arrays of n_groups
+        length.
+
+    '''
+    mod = np.asarray(mod, dtype=float)
+    obs = np.asarray(obs, dtype=float)
+    group = np.asarray(group)
+    m_ok = ~np.isnan(mod)
+    o_ok = ~np.isnan(obs)
+    cc = m_ok & o_ok
+    m = mod[cc]
+    o = obs[cc]
+    g = group[cc]
+    if wind_dir:
+        dif = wind_dir_diff_array(m, o)
+    else:
+        dif = m - o
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = m / o
+
+    def group_sum(weights, grp=g):
+        return np.bincount(grp, weights=weights, minlength=n_groups)
+
+    n = np.bincount(g, minlength=n_groups)
+    sums = {
+        'n': n,
+        'sum_m': group_sum(m),
+        'sum_o': group_sum(o),
+        'sum_mm': group_sum(m * m),
+        'sum_oo': group_sum(o * o),
+        'sum_mo': group_sum(m * o),
+        'sum_dif': group_sum(dif),
+        'sum_abs': group_sum(np.abs(dif)),
+        'sum_sq': group_sum(dif * dif),
+        'fac2': np.bincount(g[(ratio >= 0.5) & (ratio <= 2.0)],
+                            minlength=n_groups),
+        'n_m_all': np.bincount(group[m_ok], minlength=n_groups),
+        'sum_m_all': group_sum(mod[m_ok], grp=group[m_ok]),
+        'sum_mm_all': group_sum(mod[m_ok]**2, grp=group[m_ok]),
+        'n_o_all': np.bincount(group[o_ok], minlength=n_groups),
+        'sum_o_all': group_sum(obs[o_ok], grp=group[o_ok]),
+        'sum_oo_all': group_sum(obs[o_ok]**2, grp=group[o_ok])}
+    if obs_ref is None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            obs_ref = sums['sum_o'] / np.where(n > 0, n, np.nan)
+    obs_ref = np.broadcast_to(np.asarray(obs_ref, dtype=float), (n_groups,))
+    sums['ioa_ref'] = obs_ref
+    sums['ioa_den'] = group_sum((np.abs(m - obs_ref[g]) +
+                                 np.abs(o - obs_ref[g]))**2)
+    if net_ref is not None:
+        sums['ioa_den_net'] = group_sum((np.abs(m - net_ref) +
+                                         np.abs(o - net_ref))**2)
+    return sums
+
+
+def all_aqs_sums(model_dic, obs_dic, var=None, obs_ref=None, net_ref=None):
+    '''
+    Sufficient statistics for all variables for all evaluated
+    stations
+
+    Parameters
+    ----------
+    model_dic : dict or xarray Dataset
+        Dictionary containing data frames with station data from model.
+    obs_dic : dict or xarray Dataset
+        Dictionary containing data frames with station data from aqs.
+    var : list of str, optional
+        Variables to evaluate. The default is None (all observation
+        columns).
+    obs_ref : dict, optional
+        Reference observed mean per variable (or per (aqs, pol)) for
+        IOA, see stat_sums(). The default is None.
+    net_ref : dict, optional
+        Network observed mean per variable, adds the ioa_den_net
+        column (see stat_sums()). The default is None.
+
+    Returns
+    -------
+    sums : pandas DataFrame
+        Sums with (aqs, pol) index.
+
+    '''
+    if isinstance(model_dic, xr.Dataset) and isinstance(obs_dic, xr.Dataset):
+        return dataset_sums(model_dic, obs_dic, var=var, obs_ref=obs_ref,
+                            net_ref=net_ref)
+    model_dic = sd.as_station_dict(model_dic)
+    obs_dic = sd.as_station_dict(obs_dic)
+    rows = {}
+    for k in model_dic:
+        var_to_eval = obs_dic[k].columns if var is None else var
+        for v in var_to_eval:
+            mod, obs = aligned_values(model_dic[k], obs_dic[k], v)
+            ref = None if obs_ref is None else obs_ref.get((k, v),
+                                                           obs_ref.get(v))
+            if ref is not None and np.isnan(ref):
+                ref = None
+            net = None if net_ref is None else net_ref.get(v)
+            rows[(k, v)] = stat_sums(mod, obs, wind_dir=(v == 'wd'),
+                                     obs_ref=ref, net_ref=net)
+    sums = pd.DataFrame.from_dict(rows, orient='index')
+    sums.index.names = ['aqs', 'pol']
+    return sums
+
+
+def dataset_sums(model_ds, obs_ds, var=None, obs_ref=None, net_ref=None):
+    '''
+    all_aqs_sums() for station Datasets (see station_data), all
+    stations of a variable at once with one group per station
+
+    Parameters
+    ----------
+    model_ds : xarray Dataset
+        Model station data.
+    obs_ds : xarray Dataset
+        Observed station data.
+    var : list of str, optional
+        Variables to evaluate. The default is None (all observed
+        variables).
+    obs_ref : dict, optional
+        Reference observed mean per variable (or per (aqs, pol)) for
+        IOA, see stat_sums(). The default is None.
+    net_ref : dict, optional
+        Network observed mean per variable, see all_aqs_sums(). The
+        default is None.
+
+    Returns
+    -------
+    sums : pandas DataFrame
+        Sums with (aqs, pol) index.
+
+    '''
+    model_ds, obs_ds = sd.align_datasets(model_ds, obs_ds)
+    if var is None:
+        var = list(obs_ds.data_vars)
+    aqs_list = list(model_ds.station.values)
+    n_aqs = len(aqs_list)
+    tables = []
+    for v in var:
+        if v not in model_ds or v not in obs_ds:
+            continue
+        mod = model_ds[v].transpose('station', 'date').values
+        obs = obs_ds[v].transpose('station', 'date').values
+        group = np.repeat(np.arange(n_aqs), mod.shape[1])
+        ref = None
+        if obs_ref is not None:
+            ref = np.array([obs_ref.get((k, v), obs_ref.get(v, np.nan))
+                            for k in aqs_list], dtype=float)
+            if np.isnan(ref).any():
+                own = group_stat_sums(mod.ravel(), obs.ravel(), group,
+                                      n_aqs, wind_dir=(v == 'wd'))
+                ref = np.where(np.isnan(ref), own['ioa_ref'], ref)
+        net = None if net_ref is None else net_ref.get(v)
+        sums = group_stat_sums(mod.ravel(), obs.ravel(), group, n_aqs,
+                               wind_dir=(v == 'wd'), obs_ref=ref,
+                               net_ref=net)
+        index = pd.MultiIndex.from_product([aqs_list, [v]],
+                                           names=['aqs', 'pol'])
+        tables.append(pd.DataFrame(sums, index=index))
+    sums = pd.concat(tables)
+    order = pd.MultiIndex.from_product([aqs_list, var],
+                                       names=['aqs', 'pol'])
+    return sums.reindex(order[order.isin(sums.index)])
+
+
+def merge_sums(sums, level=None):
+    '''
+    Merge sufficient statistics
+
+    Parameters
+    ----------
+    sums : pandas DataFrame or list of DataFrame
+        all_aqs_sums() output, e.g. from several time chunks or
+        processes.
+    level : str or list of str, optional
+        Index levels to keep. The default is None, which keeps all
+        levels (merge time chunks). Use 'pol' to merge all stations
+        (network-wide sums).
+
+    Returns
+    -------
+    sums : pandas DataFrame
+        Merged sums. ioa_ref is NaN when merged sums used different
+        ioa_ref.
+
+    '''
+    if isinstance(sums, (list, tuple)):
+        sums = pd.concat(sums)
+    if level is None:
+        level = list(sums.index.names)
+    groups = sums.groupby(level=level, sort=False)
+    merged = groups[SUM_COLUMNS].sum()
+    ref_min = groups['ioa_ref'].min()
+    ref_max = groups['ioa_ref'].max()
+    merged['ioa_ref'] = ref_min.where(ref_min == ref_max)
+    return merged
+
+
+def stats_from_sums(sums, ioa_exact=True):
+    '''
+    Emery et al. (2017) statistics from sufficient statistics, same
+    values as all_stats()
+
+    Parameters
+    ----------
+    sums : pandas DataFrame
+        all_aqs_sums() or merge_sums() output.
+    ioa_exact : Bool, optional
+        Return IOA only when ioa_ref is the mean of the observations.
+        If False, IOA is calculated with ioa_ref as observed mean.
+        The default is True.
+
+    Returns
+    -------
+    stats : pandas DataFrame
+        N, Om, Mm, Ostd, Mstd, MB, ME, RMSE, NMB, NME, R, R2, IOA
+        and FAC2 for each row of sums. IOA is NaN when ioa_ref is
+        not the mean of the observations and ioa_exact=True.
+
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n = sums.n.where(sums.n > 0)
+        n_m = sums.n_m_all
+        n_o = sums.n_o_all
+        o_mean = sums.sum_o / n
+        r = ((n * sums.sum_mo - sums.sum_m * sums.sum_o) /
+             np.sqrt((n * sums.sum_mm - sums.sum_m**2) *
+                     (n * sums.sum_oo - sums.sum_o**2)))
+        r = r.where(n > 1)
+        if ioa_exact:
+            ref_ok = np.isclose(sums.ioa_ref, o_mean, rtol=1e-9, atol=1e-12)
+        else:
+            ref_ok = sums.ioa_ref.notna()
+        stats = pd.DataFrame({
+            'N': n,
+            'Om': sums.sum_o_all / n_o.where(n_o > 0),
+            'Mm': sums.sum_m_all / n_m.where(n_m > 0),
+            'Ostd': np.sqrt(((sums.sum_oo_all - sums.sum_o_all**2 / n_o) /
+                             (n_o - 1)).clip(lower=0).where(n_o > 1)),
+            'Mstd': np.sqrt(((sums.sum_mm_all - sums.sum_m_all**2 / n_m) /
+                             (n_m - 1)).clip(lower=0).where(n_m > 1)),
+            'MB': sums.sum_dif / n,
+            'ME': sums.sum_abs / n,
+            'RMSE': np.sqrt(sums.sum_sq / n),
+            'NMB': sums.sum_dif / sums.sum_o.where(n > 0) * 100,
+            'NME': sums.sum_abs / sums.sum_o.where(n > 0) * 100,
+            'R': r,
+            'R2': r**2,
+            'IOA': (1 - sums.sum_sq / sums.ioa_den).where(ref_ok),
+            'FAC2': sums.fac2 / n}, index=sums.index)
+
+    # Only N, MB and ME are used for wind direction
+    if 'pol' in sums.index.names:
+        is_wd = sums.index.get_level_values('pol') == 'wd'
+        stats.loc[is_wd, ['Om', 'Mm', 'Ostd', 'Mstd', 'RMSE', 'NMB', 'NME',
+                          'R', 'R2', 'IOA', 'FAC2']] = np.nan
+    return stats
+
+
+def global_stat_from_sums(sums):
+    '''
+    Global statistics from all_aqs_sums() output. For an exact global
+    IOA, compute the sums with obs_ref=global_obs_mean(sums) of a
+    previous pass.
+
+    Parameters
+    ----------
+    sums : pandas DataFrame
+        Sums with (aqs, pol) index.
+
+    Returns
+    -------
+    stats : pandas DataFrame
+        Contain global statistics.
+
+    '''
+    return stats_from_sums(merge_sums(sums, level='pol'))
+
+
+def global_obs_mean(sums):
+    '''
+    Network-wide mean of observations with model pair, per variable,
+    to be used as obs_ref in all_aqs_sums()
+    '''
+    net = merge_sums(sums, level='pol')
+    return (net.sum_o / net.n).to_dict()
+
+
+# Time groups for grouped_stats()
+TIME_GROUPS = {
+    'hour': lambda date: date.hour,
+    'day': lambda date: date.normalize(),
+    'month': lambda date: date.year * 100 + date.month,
+    'dayofweek': lambda date: date.dayofweek
+}
+
+
+@prof.profiled('grouped_stats')
+def grouped_stats(model_dic, obs_dic, by='hour', var=None):
+    '''
+    Calculate all statistic per station, variable and time group
+    (e.g. diurnal profile of statistics) in one pass, without
+    slicing the DataFrames.
+
+    Parameters
+    ----------
+    model_dic : dict or xarray Dataset
+        Dictionary containing data frames with station data from model.
+    obs_dic : dict or xarray Dataset
+        Dictionary containing data frames with station data from aqs.
+    by : str or function, optional
+        'hour', 'day', 'month', 'dayofweek' or a function that takes
+        the DatetimeIndex and returns the group of each date. The
+        default is 'hour'.
+    var : list of str, optional
+        Variables to evaluate. The default is None (all observation
+        columns).
+
+    Returns
+    -------
+    stats : pandas DataFrame
+        Tidy table with aqs, pol and group columns and all_stats()
+        statistics.
+
+    '''
+    model_dic = sd.as_station_dict(model_dic)
+    obs_dic = sd.as_station_dict(obs_dic)
+    group_fun = TIME_GROUPS[by] if isinstance(by, str) else by
+    if var is None:
+        var = list(dict.fromkeys(v for k in model_dic
+                                 for v in obs_dic[k].columns))
+    tables = []
+    for v in var:
+        aqs_list = [k for k in model_dic if v in obs_dic[k].columns]
+        if not aqs_list:
+            continue
+        mods, obss, labels, aqs_num = [], [], [], []
+        for i, k in enumerate(aqs_list):
+            mod, obs, date = aligned_values(model_dic[k], obs_dic[k], v,
+                                            return_index=True)
+            mods.append(mod)
+            obss.append(obs)
+            labels.append(np.asarray(group_fun(date)))
+            aqs_num.append(np.full(mod.size, i))
+        codes, groups = pd.factorize(np.concatenate(labels), sort=True)
+        n_groups = len(groups)
+        group = np.concatenate(aqs_num) * n_groups + codes
+        sums = group_stat_sums(np.concatenate(mods), np.concatenate(obss),
+                               group, len(aqs_list) * n_groups,
+                               wind_dir=(v == 'wd'))
+        index = pd.MultiIndex.from_product([aqs_list, [v], groups],
+                                           names=['aqs', 'pol', 'group'])
+        sums = pd.DataFrame(sums, index=index)
+        tables.append(stats_from_sums(sums[sums.n_m_all + sums.n_o_all > 0]))
+    stats = pd.concat(tables).reset_index()
+    return stats
+
+
+def pair_obs_mean(model_dic, obs_dic, var=None):
+    '''
+    Network-wide mean of observations with model pair, per variable,
+    without computing the sums (same as global_obs_mean())
+    '''
+    sum_o = {}
+    n = {}
+    for k in model_dic:
+        var_to_eval = obs_dic[k].columns if var is None else var
+        for v in var_to_eval:
+            mod, obs = aligned_values(model_dic[k], obs_dic[k], v)
+            cc = ~np.isnan(mod) & ~np.isnan(obs)
+            sum_o[v] = sum_o.get(v, 0.0) + obs[cc].sum()
+            n[v] = n.get(v, 0) + np.count_nonzero(cc)
+    return {v: sum_o[v] / n[v] if n[v] > 0 else np.nan for v in sum_o}
+
+
+class IncrementalEvaluation:
+    '''
+    Model evaluation that is updated as new forecast hours and
+    observations arrive. Only model-observation pairs newer than the
+    last ingested hour of each station are used in each update, so
+    history is never recomputed.
+
+    IOA uses as observed mean the one of the first update of each
+    station (the network one for global statistics), so it is exact
+    after the first update and an approximation afterwards.
+
+    Parameters
+    ----------
+    date_start : str, optional
+        Date after spin-up in %Y-%m-%d. The default is None.
+
+    '''
+
+    def __init__(self, date_start=None):
+        self.date_start = date_start
+        self.last_time = {}
+        self.station_ref = {}
+        self.global_ref = {}
+        self.sums = None
+        self.global_sums = None
+
+    def new_pairs(self, model_dic, obs_dic):
+        '''
+        Model and observation rows not ingested yet. Model hours after
+        the last observed hour are left for the next update.
+        '''
+        model_dic = sd.as_station_dict(model_dic)
+        obs_dic = sd.as_station_dict(obs_dic)
+        new_model = {}
+        new_obs = {}
+        for k in model_dic:
+            if k not in obs_dic:
+                continue
+            model_df = model_dic[k]
+            if self.date_start is not None:
+                model_df = model_df[self.date_start:]
+            obs_last = obs_dic[k].dropna(how='all').index.max()
+            if model_df.empty or pd.isnull(obs_last):
+                continue
+            new = model_df.index <= obs_last
+            if k in self.last_time:
+                new &= model_df.index > self.last_time[k]
+            if new.any():
+                new_model[k] = model_df[new]
+                new_obs[k] = obs_dic[k].reindex(new_model[k].index)
+                self.last_time[k] = new_model[k].index.max()
+        return (new_model, new_obs)
+
+    def update(self, model_dic, obs_dic):
+        '''
+        Ingest new model and observation hours
+
+        Parameters
+        ----------
+        model_dic : dict or xarray Dataset
+            Dictionary containing data frames with station data from
+            model (all hours or only the new ones).
+        obs_dic : dict or xarray Dataset
+            Dictionary containing data frames with station data from aqs.
+
+        Returns
+        -------
+        int
+            Number of new model-observation pairs.
+
+        '''
+        new_model, new_obs = self.new_pairs(model_dic, obs_dic)
+        if not new_model:
+            return 0
+
+        # Network means are needed before the sums only the first time
+        # a variable has pairs
+        if any(np.isnan(self.global_ref.get(v, np.nan))
+               for k in new_obs for v in new_obs[k].columns):
+            for var, ref in pair_obs_mean(new_model, new_obs).items():
+                if np.isnan(self.global_ref.get(var, np.nan)):
+                    self.global_ref[var] = ref
+        sums = all_aqs_sums(new_model, new_obs, obs_ref=self.station_ref,
+                            net_ref=self.global_ref)
+        for key, ref in sums.ioa_ref.items():
+            if np.isnan(self.station_ref.get(key, np.nan)):
+                self.station_ref[key] = ref
+
+        # Global sums from the station sums, IOA with the network mean
+        net_den = sums.pop('ioa_den_net').groupby(level='pol',
+                                                  sort=False).sum()
+        global_sums = merge_sums(sums, level='pol')
+        global_sums['ioa_den'] = net_den
+        global_sums['ioa_ref'] = pd.Series(self.global_ref)
+
+        if self.sums is None:
+            self.sums = sums
+            self.global_sums = global_sums
+        else:
+            self.sums = merge_sums([self.sums, sums])
+            self.global_sums = merge_sums([self.global_sums, global_sums])
+        return int(sums.n.sum())
+
+    def station_stats(self):
+        '''
+        Statistics per station and variable, as all_aqs_all_vars()
+        '''
+        stats = stats_from_sums(self.sums, ioa_exact=False)
+        stats['aqs'] = stats.index.get_level_values('aqs')
+        return stats.droplevel('aqs')
+
+    def global_stats(self):
+        '''
+        Global statistics per variable, as global_stat()
+        '''
+        return stats_from_sums(self.global_sums, ioa_exact=False)
+
+
 def r_pearson_significance(n, r, alpha, deg_free = 2):
     '''
     Calculate Pearson's R significance. With a two-tail
@@ -692,7 +1404,7 @@ def photo_profile(df, main, ax = None, save_fig=False, frmt=None):
     Plot.
 
     '''
-    df_d = df.groupby(df.index.hour).mean()
+    df_d = df.groupby(df.index.hour).mean(numeric_only=True)
     if ax is None:
         ax = plt.gca()
     ax.plot(df_d.no, color='orange', label='NO')
@@ -739,7 +1451,137 @@ def photo_profile_comparison(model_df, obs_df, save_fig=False, frmt=None):
                      + frmt)
         plt.savefig(file_name, bbox_inches="tight", dpi=300)
         plt.clf()
-    
-    
 
- 
+
+def draw_vs(ax, model_df, obs_df, var, ylab):
+    '''
+    Draw simple_vs_plot() temporal serie on ax
+    '''
+    obs_df[var].plot(ax=ax, label = 'Obs.', linewidth=2.5,
+                     marker='D')
+    # Through pandas too, so both series share the same date axis
+    model_df[var].plot(ax=ax, color='orange', linewidth=-2.5, label='WRF',
+                       marker='o')
+    ax.legend()
+    ax.set_xlabel('')
+    ax.set_ylabel(ylab)
+    ax.set_title(model_df.name.unique()[0])
+
+
+def photo_comparison_figure(model_df, obs_df, fig=None):
+    '''
+    photo_profile_comparison() on an explicit Figure, without pyplot
+    global state
+
+    Parameters
+    ----------
+    model_df : pandas DataFrame
+        Model DataFrame with columns NO, NO2 and O3.
+    obs_df : pandas DataFrame
+        Observations DataFrame with columns NO, NO2 and O3.
+    fig : matplotlib Figure, optional
+        Figure to reuse. The default is None.
+
+    Returns
+    -------
+    fig : matplotlib Figure
+        Figure with the comparison.
+
+    '''
+    if fig is None:
+        fig = Figure(figsize=(12, 5))
+    else:
+        fig.clear()
+    axes = fig.subplots(nrows=1, ncols=2)
+    photo_profile(obs_df, "Observations", ax=axes[0])
+    photo_profile(model_df, "WRF-Chem", ax=axes[1])
+    fig.suptitle(model_df.name.unique()[0])
+    return fig
+
+
+def station_plots(job):
+    '''
+    Render and save all the plots of one station, reusing one figure
+    for all the variables. Used by batch_plots().
+
+    Parameters
+    ----------
+    job : tuple
+        (model_df, obs_df, var_labels, photo, frmt, dpi, out_dir).
+
+    Returns
+    -------
+    file_names : list of str
+        Saved figures.
+
+    '''
+    model_df, obs_df, var_labels, photo, frmt, dpi, out_dir = job
+    name = model_df.name.unique()[0]
+    with prof.stage('station_plots', station=name,
+                    rows=len(model_df.index)):
+        file_names = []
+        fig = Figure()
+        ax = fig.subplots()
+        for var, ylab in var_labels.items():
+            if var not in obs_df.columns or var not in model_df.columns:
+                continue
+            ax.clear()
+            draw_vs(ax, model_df, obs_df, var, ylab)
+            file_name = os.path.join(out_dir, var + '_' + name + frmt)
+            fig.savefig(file_name, bbox_inches="tight", dpi=dpi)
+            file_names.append(file_name)
+        if photo:
+            fig = photo_comparison_figure(model_df, obs_df, fig=fig)
+            fig.set_size_inches(12, 5)
+            file_name = os.path.join(out_dir, 'photo_comp' + '_' + name + frmt)
+            fig.savefig(file_name, bbox_inches="tight", dpi=dpi)
+            file_names.append(file_name)
+    return file_names
+
+
+@prof.profiled('batch_plots')
+def batch_plots(model_dic, obs_dic, var_labels, photo=False, frmt='.png',
+                dpi=300, out_dir='.', n_workers=1):
+    '''
+    Save simple_vs_plot() for all stations and variables, and
+    photo_profile_comparison() for all stations, across a process pool.
+    Figures are explicit matplotlib Figure objects, so pyplot backend
+    and state are not used.
+
+    Parameters
+    ----------
+    model_dic : dict or xarray Dataset
+        Dictionary containing data frames with station data from model.
+    obs_dic : dict or xarray Dataset
+        Dictionary containing data frames with station data from aqs.
+    var_labels : dict
+        Y axis label of each variable, e.g. {'t2': '$T2 \\; (K)$'}.
+    photo : Bool, optional
+        Also save NO, NO2 and O3 profile comparison. The default is
+        False.
+    frmt : str, optional
+        Format of figures. The default is '.png'.
+    dpi : int, optional
+        Resolution of figures. The default is 300.
+    out_dir : str, optional
+        Output folder. The default is '.'.
+    n_workers : int, optional
+        Number of worker processes. The default is 1.
+
+    Returns
+    -------
+    file_names : list of str
+        Saved figures.
+
+    '''
+    model_dic = sd.as_station_dict(model_dic)
+    obs_dic = sd.as_station_dict(obs_dic)
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = [(model_dic[k], obs_dic[k], var_labels, photo, frmt, dpi, out_dir)
+            for k in model_dic]
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            file_names = list(pool.map(station_plots, jobs))
+    else:
+        file_names = [station_plots(job) for job in jobs]
+    return [name for names in file_names for name in names]
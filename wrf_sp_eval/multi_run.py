@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Evaluation of several WRF-Chem runs (e.g. emission scenarios or physics
+options) of the same domain against the same CETESB observations.
+"""
+
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import wrf_sp_eval.data_preparation as dp
+import wrf_sp_eval.model_stats as ms
+import wrf_sp_eval.station_data as sd
+
+
+def run_extract(job):
+    '''
+    Extract station data of one run, used by the worker processes
+
+    Parameters
+    ----------
+    job : tuple
+        (cetesb_dom, wrf_files, extract_vars, to_local).
+
+    Returns
+    -------
+    Dicitionary, each key is a station.
+
+    '''
+    cetesb_dom, wrf_files, extract_vars, to_local = job
+    return dp.cetesb_from_wrf_files(cetesb_dom, wrf_files, extract_vars,
+                                    to_local=to_local)
+
+
+def align_obs(model_dic, obs_dic, aligned=None):
+    '''
+    Observations at model dates, compared as integer UTC hours as in
+    model_eval_setup(). Stations with the same model hours as an
+    already aligned run reuse it.
+
+    Parameters
+    ----------
+    model_dic : dict
+        Model dictionary after spin-up removal.
+    obs_dic : dict
+        Observation dictionary.
+    aligned : dict, optional
+        Previously aligned (model hours, observations) per station,
+        updated in place. The default is None.
+
+    Returns
+    -------
+    obs_run : dict
+        Observations at model dates, NaN where there is no observation.
+
+    '''
+    if aligned is None:
+        aligned = {}
+    obs_run = {}
+    for aqs in model_dic:
+        date = model_dic[aqs].index
+        hours = dp.hours_since_epoch(date)
+        if aqs not in aligned or not np.array_equal(aligned[aqs][0], hours):
+            rows, found = dp.hour_positions(
+                dp.hours_since_epoch(obs_dic[aqs].index), hours)
+            aligned[aqs] = (hours, dp.take_hours(obs_dic[aqs], rows, found,
+                                                 date))
+        obs_run[aqs] = aligned[aqs][1]
+    return obs_run
+
+
+def multi_run_eval(runs, cetesb_dom, obs_dic, extract_vars, date_start,
+                   to_local=True, n_workers=1, csv=False):
+    '''
+    Evaluate several runs against the same observations. Stations
+    (cetesb_dom) and observations are prepared once, runs are
+    extracted in parallel processes.
+
+    Parameters
+    ----------
+    runs : dict
+        wrfout files (list or glob pattern) of each run, e.g.
+        {'base': 'base/wrfout_d02_*', 'no_vehicles': 'nov/wrfout_d02_*'}.
+    cetesb_dom : pandas DataFrame
+        Information of stations, from stations_in_domains().
+    obs_dic : dict or xarray Dataset
+        Dictionary with observation DataFrames or station Dataset. To
+        evaluate met and pollutants together join both dictionaries
+        per station.
+    extract_vars : function
+        Module level function that takes an opened wrfout and returns
+        the tuple of variables to extract, see cetesb_from_wrf_files().
+    date_start : string
+        Date after spin-up in %Y-%m-%d.
+    to_local : Bool, optional
+        Transform model dates to local time. The default is True.
+    n_workers : int, optional
+        Number of worker processes. The default is 1.
+    csv : bool, optional
+        Export the statistics to multi_run_stats.csv. The default is
+        False.
+
+    Returns
+    -------
+    stats : pandas DataFrame
+        All statistics with (run, aqs, pol) index.
+
+    '''
+    obs_dic = sd.as_station_dict(obs_dic, to_local=to_local)
+    jobs = [(cetesb_dom, wrf_files, extract_vars, to_local)
+            for wrf_files in runs.values()]
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            run_dics = list(pool.map(run_extract, jobs))
+    else:
+        run_dics = [run_extract(job) for job in jobs]
+
+    aligned = {}
+    stats = {}
+    for run, wrf_dic in zip(runs, run_dics):
+        model_run = {aqs: wrf_dic[aqs][date_start:] for aqs in wrf_dic
+                     if aqs in obs_dic}
+        obs_run = align_obs(model_run, obs_dic, aligned)
+        stats[run] = (ms.all_aqs_all_vars(model_run, obs_run)
+                      .set_index('aqs', append=True)
+                      .swaplevel())
+    stats = pd.concat(stats, names=['run', 'aqs', 'pol'])
+    if csv:
+        stats.to_csv("multi_run_stats.csv", sep=",")
+    return stats
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Timing and memory of the evaluation stages (QUALAR download and parse,
+wrfout extraction, unit conversion, model_eval_setup, statistics and
+plots), per stage and station.
+
+It is off by default. Turn it on with enable(), or with the
+WRF_SP_EVAL_PROFILE environment variable: "1" records the stages, a
+file name ending in .json or .csv also saves the report there when
+Python exits. When it is off, profiled functions only check a flag.
+
+Peak memory is taken from tracemalloc, whose peak is one for the whole
+process. Only stages run by the main thread reset and read it, so stages
+in other threads (threaded downloads) have no peak memory. Stages run in
+worker processes are recorded in the workers, not here.
+"""
+
+import os
+import json
+import time
+import atexit
+import functools
+import threading
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+
+ENV_VAR = "WRF_SP_EVAL_PROFILE"
+REPORT_COLUMNS = ['stage', 'station', 'seconds', 'peak_mb', 'rows',
+                  'requests']
+
+_enabled = False
+_memory = False
+_records = []
+_lock = threading.Lock()
+_stack = []
+
+
+def enable(memory=True):
+    '''
+    Start recording stages
+
+    Parameters
+    ----------
+    memory : Bool, optional
+        Also record peak memory with tracemalloc, which slows down
+        memory intensive stages. The default is True.
+
+    Returns
+    -------
+    None.
+
+    '''
+    global _enabled, _memory
+    _enabled = True
+    _memory = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    '''
+    Stop recording stages, records are kept until reset()
+    '''
+    global _enabled, _memory
+    _enabled = False
+    if _memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _memory = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    '''
+    Remove all records
+    '''
+    with _lock:
+        del _records[:]
+
+
+def track_memory():
+    '''
+    Whether the current stage can use the tracemalloc peak, only in
+    the main thread
+    '''
+    return (_memory and tracemalloc.is_tracing() and
+            threading.current_thread() is threading.main_thread())
+
+
+def count_rows(result):
+    '''
+    Rows of a stage result: DataFrame rows, sum of rows of a
+    dictionary of DataFrames, or station x time points of xarray
+    objects
+    '''
+    if isinstance(result, tuple) and result:
+        result = result[0]
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        return len(result.index)
+    if isinstance(result, dict):
+        return sum(len(df.index) for df in result.values()
+                   if isinstance(df, (pd.DataFrame, pd.Series)))
+    sizes = getattr(result, 'sizes', None)
+    if sizes is not None:
+        return int(np.prod([n for dim, n in sizes.items()
+                            if dim not in ('variable', 'species')]))
+    return None
+
+
+class stage:
+    '''
+    Context manager that records one stage
+
+    Parameters
+    ----------
+    name : str
+        Stage name.
+    station : str or int, optional
+        Station name or code. The default is None.
+    rows : int, optional
+        Rows processed, can be set later with set_rows(). The default
+        is None.
+    requests : int, optional
+        Network requests, can be added with add_requests(). The
+        default is None.
+    '''
+
+    def __init__(self, name, station=None, rows=None, requests=None):
+        self.name = name
+        self.station = station
+        self.rows = rows
+        self.requests = requests
+
+    def set_rows(self, rows):
+        self.rows = rows
+
+    def add_requests(self, n=1):
+        self.requests = (self.requests or 0) + n
+
+    def __enter__(self):
+        self.active = _enabled
+        if not self.active:
+            return self
+        self.mem_start = 0
+        self.mem_peak = 0
+        self.memory = track_memory()
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if _stack:
+                _stack[-1].mem_peak = max(_stack[-1].mem_peak, peak)
+            tracemalloc.reset_peak()
+            self.mem_start = current
+            _stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if not self.active:
+            return False
+        seconds = time.perf_counter() - self.start
+        peak_mb = None
+        if self.memory and tracemalloc.is_tracing():
+            peak = max(self.mem_peak, tracemalloc.get_traced_memory()[1])
+            if _stack and _stack[-1] is self:
+                _stack.pop()
+            if _stack:
+                _stack[-1].mem_peak = max(_stack[-1].mem_peak, peak)
+            tracemalloc.reset_peak()
+            peak_mb = (peak - self.mem_start) / 1e6
+        record = {'stage': self.name, 'station': self.station,
+                  'seconds': seconds, 'peak_mb': peak_mb,
+                  'rows': self.rows, 'requests': self.requests}
+        with _lock:
+            _records.append(record)
+        return False
+
+
+def profiled(name):
+    '''
+    Decorator that records each call of a function as a stage, rows
+    are counted from its result (see count_rows())
+
+    Parameters
+    ----------
+    name : str
+        Stage name.
+
+    Returns
+    -------
+    function
+        Decorated function.
+
+    '''
+    def decorator(fun):
+        @functools.wraps(fun)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fun(*args, **kwargs)
+            with stage(name) as st:
+                result = fun(*args, **kwargs)
+                st.set_rows(count_rows(result))
+            return result
+        return wrapper
+    return decorator
+
+
+def report(by_station=False):
+    '''
+    Recorded stages
+
+    Parameters
+    ----------
+    by_station : Bool, optional
+        Return every record. Otherwise records are summed by stage
+        (seconds, rows and requests), with the number of calls and the
+        largest peak memory. The default is False.
+
+    Returns
+    -------
+    pandas DataFrame
+        Report.
+
+    '''
+    with _lock:
+        records = pd.DataFrame(list(_records), columns=REPORT_COLUMNS)
+    if by_station:
+        return records
+    records[['peak_mb', 'rows', 'requests']] = (
+        records[['peak_mb', 'rows', 'requests']].astype(float))
+    total = lambda values: values.sum(min_count=1)
+    summary = records.groupby('stage', sort=False).agg(
+        calls=('seconds', 'size'), seconds=('seconds', 'sum'),
+        peak_mb=('peak_mb', 'max'), rows=('rows', total),
+        requests=('requests', total))
+    return summary.sort_values('seconds', ascending=False)
+
+
+def save_report(file_name, by_station=True):
+    '''
+    Save the report as json (list of records) or csv, according to
+    the file extension
+
+    Parameters
+    ----------
+    file_name : str
+        Report file name (.json or .csv).
+    by_station : Bool, optional
+        Save every record, otherwise the summary by stage. The default
+        is True.
+
+    Returns
+    -------
+    None.
+
+    '''
+    stats = report(by_station=by_station)
+    if not by_station:
+        stats = stats.reset_index()
+    if file_name.endswith('.json'):
+        records = json.loads(stats.to_json(orient='records'))
+        with open(file_name, 'w') as out:
+            json.dump(records, out, indent=2)
+    else:
+        stats.to_csv(file_name, index=False)
+
+
+def _enable_from_env():
+    value = os.environ.get(ENV_VAR, "")
+    if value.lower() in ("", "0", "false", "no"):
+        return
+    enable()
+    if value.endswith(('.json', '.csv')):
+        atexit.register(save_report, value)
+
+
+_enable_from_env()
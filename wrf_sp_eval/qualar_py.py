@@ -1,73 +1,198 @@
+import re
+import threading
 import requests
 import pandas as pd
 import datetime as dt
-from bs4 import BeautifulSoup
+import lxml.html
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+import wrf_sp_eval.profiling as prof
 
 
-# SOS from:
-# https://stackoverflow.com/questions/43359479/pandas-parsing-2400-instead-of-0000
+QUALAR_URL = "https://qualar.cetesb.sp.gov.br/qualar"
 
- 
-def my_to_datetime(date_str):
-    if date_str[11:13] != '24':
-        return pd.to_datetime(date_str, format='%d/%m/%Y_%H:%M')
+# QUALAR parameter codes
+PHOTO_PARAMETERS = {'o3': 63, 'no': 17, 'no2': 15, 'co': 16}
+MET_PARAMETERS = {'tc': 25, 'rh': 28, 'ws': 24, 'wd': 23}
 
-    date_str = date_str[0:11] + '00' + date_str[13:]
-    return pd.to_datetime(date_str, format='%d/%m/%Y_%H:%M') + \
-           dt.timedelta(days=1)
+
+class QualarClient:
+    '''
+    QUALAR client that logs in once and reuses a pooled keep-alive
+    session for all the requests. If the session expires (the
+    exported page has no data table) it logs in again and retries.
+
+    Parameters
+    ----------
+    cetesb_login : str
+        Cetesb qualAr user name.
+    cetesb_password : str
+        Cetesb qualAr password.
+    pool_size : int, optional
+        Number of kept-alive connections, use the number of
+        concurrent downloads. The default is 10.
+    qualar_url : str, optional
+        QUALAR address. The default is QUALAR_URL.
+
+    '''
+
+    table_pattern = re.compile(rb'id\s*=\s*["\']?tbl\b')
+    max_logins = 3
+
+    def __init__(self, cetesb_login, cetesb_password, pool_size=10,
+                 qualar_url=None):
+        self.login_data = {
+            'cetesb_login': cetesb_login,
+            'cetesb_password': cetesb_password
+        }
+        self.qualar_url = QUALAR_URL if qualar_url is None else qualar_url
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.logins = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def login(self, logins_seen=None):
+        with self._lock:
+            # Another thread already logged in again
+            if logins_seen is not None and self.logins != logins_seen:
+                return 0
+            self.session.post(self.qualar_url + "/autenticador",
+                              data=self.login_data)
+            self.logins += 1
+            self.requests += 1
+            return 1
+
+    def search(self, start_date, end_date, parameter, station):
+        '''
+        Request QUALAR export page for one parameter and station
+
+        Returns
+        -------
+        bytes
+            Page content with the tbl table.
+
+        '''
+        search_data = {
+            'irede': 'A',
+            'dataInicialStr':start_date,
+            'dataFinalStr':end_date,
+            'iTipoDado': 'P',
+            'estacaoVO.nestcaMonto':station,
+            'parametroVO.nparmt':parameter
+        }
+        url = self.qualar_url + "/exportaDados.do?method=pesquisar"
+        with prof.stage('qualar_search', station=station) as st:
+            if self.logins == 0:
+                st.add_requests(self.login(0))
+            for attempt in range(self.max_logins + 1):
+                logins_seen = self.logins
+                r = self.session.post(url, data=search_data)
+                st.add_requests()
+                with self._lock:
+                    self.requests += 1
+                if self.table_pattern.search(r.content):
+                    return r.content
+                st.add_requests(self.login(logins_seen))
+        raise ValueError("QUALAR did not return data table, "
+                         "check cetesb_login and cetesb_password")
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def qualar_table_rows(content):
+    '''
+    Extract the rows of QUALAR exported data table (id="tbl")
+
+    Parameters
+    ----------
+    content : bytes
+        QUALAR export page.
+
+    Returns
+    -------
+    data : list of list
+        Non empty cell texts of each data row.
+
+    '''
+    page = lxml.html.fromstring(content)
+    table = page.xpath('//table[@id="tbl"]')[0]
+    data = []
+    for row in table.xpath('.//tr')[2:]:
+        cols = [ele.text_content().strip() for ele in row.xpath('.//td')]
+        data.append([ele for ele in cols if ele])
+    return data
 
 
 def cetesb_data_download(cetesb_login, cetesb_password, 
                         start_date, end_date, 
-                        parameter, station, csv=False):     
+                        parameter, station, csv=False, client=None):     
   
-    login_data = {
-        'cetesb_login': cetesb_login,
-        'cetesb_password': cetesb_password
-    }
-    
-    search_data = {
-        'irede': 'A',
-        'dataInicialStr':start_date,
-        'dataFinalStr':end_date,
-        'iTipoDado': 'P',
-        'estacaoVO.nestcaMonto':station,
-        'parametroVO.nparmt':parameter
-    }
-    
-    with requests.Session() as s:
-        url = "https://qualar.cetesb.sp.gov.br/qualar/autenticador"
-        r = s.post(url, data=login_data)
-        url2 = "https://qualar.cetesb.sp.gov.br/qualar/exportaDados.do?method=pesquisar"
-        r = s.post(url2, data=search_data)
-        soup = BeautifulSoup(r.content, 'lxml')
-        
-    data = []
-    table = soup.find('table', attrs={'id':'tbl'})
-    rows = table.find_all('tr')
-    row_data = rows[2:]
-    for row in row_data:
-        cols = row.find_all('td')
-        cols = [ele.text.strip() for ele in cols]
-        data.append([ele for ele in cols if ele])    
-        
-    dat = pd.DataFrame(data)
+    if client is None:
+        with QualarClient(cetesb_login, cetesb_password) as client:
+            content = client.search(start_date, end_date, parameter, station)
+    else:
+        content = client.search(start_date, end_date, parameter, station)
+    with prof.stage('qualar_parse', station=station) as st:
+        dat_complete = qualar_data_frame(content, start_date, end_date)
+        st.set_rows(len(dat_complete.index))
+    file_name = str(parameter) + '_' + str(station) +' .csv'
+    if csv:
+        dat_complete.to_csv(file_name, index_label='date')
+    else:
+        return dat_complete
+
+
+def qualar_data_frame(content, start_date, end_date):
+    '''
+    Transform QUALAR export page into an hourly DataFrame
+
+    Parameters
+    ----------
+    content : bytes
+        QUALAR export page.
+    start_date : str
+        Start date in %d/%m/%Y.
+    end_date : str
+        End date in %d/%m/%Y.
+
+    Returns
+    -------
+    dat_complete : pandas DataFrame
+        Data for all hours between start_date and end_date.
+
+    '''
+    dat = pd.DataFrame(qualar_table_rows(content))
            
     # Creating a complete df with all dates
     day1 = pd.to_datetime(start_date, format='%d/%m/%Y')
     day2 = pd.to_datetime(end_date, format='%d/%m/%Y') + dt.timedelta(days=1)
     all_date = pd.DataFrame(index=pd.date_range(day1.strftime('%m/%d/%Y'), 
                                                 day2.strftime('%m/%d/%Y'),
-                                                freq='H'))
+                                                freq='h'))
     if len(dat) <= 1:
         dat = pd.DataFrame(columns=['day', 'hour', 'name', 'pol_name', 'units', 'val'])        
     else:    
         dat = dat[[3, 4, 6, 7, 8, 9]]
         dat.columns = ['day', 'hour', 'name', 'pol_name', 'units', 'val']
-        dat['date'] = dat.day + '_' + dat.hour
-
-        # Changing date type to string to datestamp
-        dat['date'] = dat.date.apply(my_to_datetime)
+        # Changing date type to string to datestamp, 24:00 is 00:00
+        # of the next day
+        hour_24 = dat.hour.str.startswith('24')
+        dat['date'] = (pd.to_datetime(dat.day + '_' + 
+                                      dat.hour.where(~hour_24, 
+                                                     '00' + dat.hour.str[2:]),
+                                      format='%d/%m/%Y_%H:%M') + 
+                       pd.to_timedelta(hour_24.astype(int), unit='D'))
 
         # Changing val type from string/object to numeric
         dat['val'] = dat.val.str.replace(',', '.').astype(float)
@@ -77,24 +202,66 @@ def cetesb_data_download(cetesb_login, cetesb_password,
        
     
     dat_complete = all_date.join(dat)
-    file_name = str(parameter) + '_' + str(station) +' .csv'
-    if csv:
-        dat_complete.to_csv(file_name, index_label='date')
-    else:
-        return dat_complete
+    return dat_complete
 
 
-def all_photo(cetesb_login, cetesb_password, start_date, end_date, station, 
-              csv_photo=False):
-    o3 = cetesb_data_download(cetesb_login, cetesb_password, 
-                              start_date, end_date, 63, station)
-    no = cetesb_data_download(cetesb_login, cetesb_password, 
-                              start_date, end_date, 17, station)
-    no2 = cetesb_data_download(cetesb_login, cetesb_password, 
-                               start_date, end_date, 15, station)
-    co = cetesb_data_download(cetesb_login, cetesb_password, 
-                              start_date, end_date, 16, station)
-    
+def download_parameters(cetesb_login, cetesb_password, start_date,
+                        end_date, jobs, n_workers=1, client=None,
+                        download=None):
+    '''
+    Download several QUALAR series. When n_workers > 1 the downloads
+    run concurrently in a thread pool.
+
+    Parameters
+    ----------
+    cetesb_login : str
+        Cetesb qualAr user name.
+    cetesb_password : str
+        Cetesb qualAr password.
+    start_date : str
+        Start date in %d/%m/%Y.
+    end_date : str
+        End date in %d/%m/%Y.
+    jobs : list of tuple
+        (parameter, station) codes to download.
+    n_workers : int, optional
+        Maximum number of concurrent downloads. The default is 1.
+    client : QualarClient, optional
+        Logged session to reuse. If None, one client is created for
+        all the jobs. The default is None.
+    download : function, optional
+        Function with cetesb_data_download() arguments used for each
+        job (e.g. a cached download). The default is None, which uses
+        cetesb_data_download().
+
+    Returns
+    -------
+    list of pandas DataFrame
+        cetesb_data_download() output in the same order as jobs.
+
+    '''
+    if client is None:
+        with QualarClient(cetesb_login, cetesb_password,
+                          pool_size=max(n_workers, 1)) as client:
+            return download_parameters(cetesb_login, cetesb_password,
+                                       start_date, end_date, jobs,
+                                       n_workers=n_workers, client=client,
+                                       download=download)
+    if download is None:
+        download = cetesb_data_download
+
+    def job_download(job):
+        parameter, station = job
+        return download(cetesb_login, cetesb_password, start_date, end_date,
+                        parameter, station, client=client)
+
+    if n_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            return list(pool.map(job_download, jobs))
+    return [job_download(job) for job in jobs]
+
+
+def photo_frame(o3, no, no2, co):
     all_photo_df = pd.DataFrame({
         'o3': o3.val,
         'no': no.val,
@@ -103,24 +270,10 @@ def all_photo(cetesb_login, cetesb_password, start_date, end_date, station,
     }, index=o3.index)
     
     all_photo_df.index = all_photo_df.index.tz_localize('America/Sao_Paulo')
-    
-    if csv_photo:
-        all_photo_df.to_csv('all_photo_' + str(station) + '.csv',
-                            index_label='date')
-    else:
-        return all_photo_df
+    return all_photo_df
 
-    
-def all_met(cetesb_login, cetesb_password, start_date, end_date, station, 
-            in_k = False, rm_flag = True, csv_met=False):
-    tc = cetesb_data_download(cetesb_login, cetesb_password, 
-                              start_date, end_date, 25, station)
-    rh = cetesb_data_download(cetesb_login, cetesb_password, 
-                              start_date, end_date, 28, station)
-    ws = cetesb_data_download(cetesb_login, cetesb_password, 
-                              start_date, end_date, 24, station)
-    wd = cetesb_data_download(cetesb_login, cetesb_password, 
-                              start_date, end_date, 23, station)
+
+def met_frame(tc, rh, ws, wd, in_k=False, rm_flag=True):
     if in_k:
         K = 273.15
     else:
@@ -139,6 +292,34 @@ def all_met(cetesb_login, cetesb_password, start_date, end_date, station,
     if rm_flag:
         filter_flags = all_met_df['wd'] <= 360
         all_met_df['wd'].where(filter_flags, inplace=True)
+    return all_met_df
+
+
+def all_photo(cetesb_login, cetesb_password, start_date, end_date, station, 
+              csv_photo=False, n_workers=1, client=None):
+    o3, no, no2, co = download_parameters(
+        cetesb_login, cetesb_password, start_date, end_date,
+        [(parameter, station) for parameter in PHOTO_PARAMETERS.values()],
+        n_workers=n_workers, client=client)
+    
+    all_photo_df = photo_frame(o3, no, no2, co)
+    
+    if csv_photo:
+        all_photo_df.to_csv('all_photo_' + str(station) + '.csv',
+                            index_label='date')
+    else:
+        return all_photo_df
+
+    
+def all_met(cetesb_login, cetesb_password, start_date, end_date, station, 
+            in_k = False, rm_flag = True, csv_met=False, n_workers=1,
+            client=None):
+    tc, rh, ws, wd = download_parameters(
+        cetesb_login, cetesb_password, start_date, end_date,
+        [(parameter, station) for parameter in MET_PARAMETERS.values()],
+        n_workers=n_workers, client=client)
+    
+    all_met_df = met_frame(tc, rh, ws, wd, in_k=in_k, rm_flag=rm_flag)
     
     # Export to csv
     if csv_met:
@@ -147,4 +328,48 @@ def all_met(cetesb_login, cetesb_password, start_date, end_date, station,
     else:
         return all_met_df
 
-    
+
+def all_photo_stations(cetesb_login, cetesb_password, start_date, end_date,
+                       stations, n_workers=1, client=None, download=None):
+    '''
+    all_photo() for several stations, downloading all stations and
+    parameters concurrently when n_workers > 1.
+
+    Returns
+    -------
+    dict
+        all_photo() DataFrame per station code.
+
+    '''
+    jobs = [(parameter, station) for station in stations
+            for parameter in PHOTO_PARAMETERS.values()]
+    dat = download_parameters(cetesb_login, cetesb_password, start_date,
+                              end_date, jobs, n_workers=n_workers,
+                              client=client, download=download)
+    n_par = len(PHOTO_PARAMETERS)
+    return {station: photo_frame(*dat[i * n_par:(i + 1) * n_par])
+            for i, station in enumerate(stations)}
+
+
+def all_met_stations(cetesb_login, cetesb_password, start_date, end_date,
+                     stations, in_k=False, rm_flag=True, n_workers=1,
+                     client=None, download=None):
+    '''
+    all_met() for several stations, downloading all stations and
+    parameters concurrently when n_workers > 1.
+
+    Returns
+    -------
+    dict
+        all_met() DataFrame per station code.
+
+    '''
+    jobs = [(parameter, station) for station in stations
+            for parameter in MET_PARAMETERS.values()]
+    dat = download_parameters(cetesb_login, cetesb_password, start_date,
+                              end_date, jobs, n_workers=n_workers,
+                              client=client, download=download)
+    n_par = len(MET_PARAMETERS)
+    return {station: met_frame(*dat[i * n_par:(i + 1) * n_par],
+                               in_k=in_k, rm_flag=rm_flag)
+            for i, station in enumerate(stations)}
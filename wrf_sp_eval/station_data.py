@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Station data container: model or observation data of all stations in
+one xarray Dataset with (station, date) dimensions, one float32 data
+variable per parameter, dates in UTC and station code as a station
+coordinate. Station metadata is kept once, not in every hourly row.
+
+The legacy dictionaries of station DataFrames (cetesb_from_wrf() and
+download_load_*() output) are converted with dict_to_dataset() and
+dataset_to_dict().
+"""
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+# Time zone of naive station dates (CETESB data)
+LOCAL_TIME_ZONE = "America/Sao_Paulo"
+
+
+def data_time_zone(station_dic):
+    '''
+    Time zone of the first tz-aware DataFrame index, LOCAL_TIME_ZONE if
+    all dates are naive
+    '''
+    for df in station_dic.values():
+        if getattr(df.index, 'tz', None) is not None:
+            return str(df.index.tz)
+    return LOCAL_TIME_ZONE
+
+
+def dict_to_dataset(station_dic, cetesb_dom=None, time_zone=None,
+                    dtype='float32'):
+    '''
+    Transform a dictionary of station DataFrames (download_load_*() or
+    cetesb_from_wrf() output) into a (station, date) xarray Dataset,
+    one data variable per parameter. Dates are kept in UTC.
+
+    Parameters
+    ----------
+    station_dic : dict
+        Dictionary containing data frames with station data.
+    cetesb_dom : pandas DataFrame, optional
+        Information of stations, used to get station codes when the
+        DataFrames have no code column. The default is None.
+    time_zone : str, optional
+        Time zone saved in the time_zone attribute and used to localize
+        naive dates. The default is None, the time zone of the
+        DataFrames dates (e.g. UTC for cetesb_from_wrf() with
+        to_local=False), or LOCAL_TIME_ZONE for naive dates.
+    dtype : str, optional
+        Data type of parameters. The default is 'float32'.
+
+    Returns
+    -------
+    xarray Dataset
+        Station data, station code as a station coordinate when
+        available.
+
+    '''
+    if time_zone is None:
+        time_zone = data_time_zone(station_dic)
+    codes = []
+    frames = []
+    name_columns = 0
+    for name, df in station_dic.items():
+        name_columns = int('name' in df.columns)
+        if cetesb_dom is not None:
+            codes.append(cetesb_dom.code[cetesb_dom.name == name].values[0])
+        elif 'code' in df.columns and len(df.index) > 0:
+            codes.append(df.code.iloc[0])
+        else:
+            codes.append(-1)
+        df = df.drop(columns=['code', 'name'], errors='ignore')
+        date = df.index
+        if date.tz is None:
+            date = date.tz_localize(time_zone)
+        df = df.set_axis(date.tz_convert('UTC').tz_localize(None))
+        df.index.name = 'date'
+        frames.append(df.astype(dtype))
+    station_ds = (pd.concat(frames, keys=list(station_dic.keys()),
+                            names=['station', 'date'])
+                  .to_xarray())
+    station_ds = station_ds.assign_coords(code=('station', codes))
+    station_ds.attrs['time_zone'] = time_zone
+    # cetesb_from_wrf() DataFrames have code and name columns
+    station_ds.attrs['name_columns'] = name_columns
+    return station_ds
+
+
+def block_to_dataset(block, time_zone=LOCAL_TIME_ZONE, dtype='float32'):
+    '''
+    Transform a (station, Time, variable) block (wrf_stations_block(),
+    wrf_points_retrieve()) into the station Dataset
+
+    Parameters
+    ----------
+    block : xarray DataArray
+        Model data at stations, Time in UTC.
+    time_zone : str, optional
+        Local time zone of the stations. The default is
+        "America/Sao_Paulo".
+    dtype : str, optional
+        Data type of parameters. The default is 'float32'.
+
+    Returns
+    -------
+    station_ds : xarray Dataset
+        Station data with model code and name columns flag.
+
+    '''
+    block = block.assign_coords(variable=[str(var) for var in
+                                          block['variable'].values])
+    station_ds = (block.astype(dtype)
+                  .rename(Time='date')
+                  .to_dataset(dim='variable'))
+    station_ds.attrs['time_zone'] = time_zone
+    station_ds.attrs['name_columns'] = 1
+    return station_ds
+
+
+def dataset_to_dict(station_ds, to_local=True):
+    '''
+    Transform a station Dataset into a dictionary of station
+    DataFrames, as used by model_stats
+
+    Parameters
+    ----------
+    station_ds : xarray Dataset
+        Station data (dict_to_dataset(), block_to_dataset()).
+    to_local : Bool, optional
+        Transform dates to the Dataset time_zone attribute, otherwise
+        keep UTC. Dates stay in UTC when the attribute is missing.
+        The default is True.
+
+    Returns
+    -------
+    station_dic : dict
+        Dictionary containing data frames with station data.
+
+    '''
+    date = pd.DatetimeIndex(station_ds.date.values,
+                            name='date').tz_localize('UTC')
+    if to_local:
+        date = date.tz_convert(station_ds.attrs.get('time_zone', 'UTC'))
+    var_names = list(station_ds.data_vars)
+    values = np.stack([station_ds[var].transpose('station', 'date').values
+                       for var in var_names], axis=-1)
+    station_dic = {}
+    for i, (name, code) in enumerate(zip(station_ds.station.values,
+                                         station_ds.code.values)):
+        df = pd.DataFrame(values[i], index=date, columns=var_names)
+        if station_ds.attrs.get('name_columns', 0):
+            df.insert(0, 'name', name)
+            df.insert(0, 'code', code)
+        station_dic[name] = df
+    return station_dic
+
+
+def as_station_dict(station_data, to_local=True):
+    '''
+    Dictionary of station DataFrames from a station Dataset or a
+    dictionary, so functions accept both
+
+    Parameters
+    ----------
+    station_data : dict or xarray Dataset
+        Station data.
+    to_local : Bool, optional
+        When station_data is a Dataset, transform dates to its time
+        zone. The default is True.
+
+    Returns
+    -------
+    station_dic : dict
+        Dictionary containing data frames with station data.
+
+    '''
+    if isinstance(station_data, xr.Dataset):
+        return dataset_to_dict(station_data, to_local=to_local)
+    return station_data
+
+
+def align_datasets(model_ds, obs_ds):
+    '''
+    Observations at model stations and both on the same dates
+
+    Parameters
+    ----------
+    model_ds : xarray Dataset
+        Model station data.
+    obs_ds : xarray Dataset
+        Observed station data.
+
+    Returns
+    -------
+    model_ds, obs_ds : xarray Dataset
+        Datasets with the same station and date coordinates, NaN where
+        there is no data.
+
+    '''
+    obs_ds = obs_ds.drop_vars('code').reindex(station=model_ds.station)
+    model_ds, obs_ds = xr.align(model_ds, obs_ds, join='outer',
+                                exclude=['station'])
+    return (model_ds, obs_ds)